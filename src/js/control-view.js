@@ -380,12 +380,21 @@ module.exports = {
               toolpath.filename = file;
               this.toolpath_progress = 1;
               this.toolpath = toolpath;
-
-              const state = this.$root.state;
-              for (const axis of "xyzabc") {
-                Vue.set(state, `path_min_${axis}`, toolpath.bounds.min[axis]);
-                Vue.set(state, `path_max_${axis}`, toolpath.bounds.max[axis]);
-              }
+              this.set_path_bounds(toolpath.bounds);
+            }
+          } else if ((toolpath.vertices && this.toolpath.vertices != toolpath.vertices) ||
+                     (toolpath.estimate && !this.toolpath.estimate)) {
+            // Draw the toolpath progressively while it is being planned and
+            // show the provisional time, lines and messages
+            this.toolpath = Object.assign({}, toolpath.estimate, {
+              filename: file,
+              partial: true,
+              vertices: toolpath.vertices,
+              estimate: !!toolpath.estimate
+            });
+
+            if (toolpath.estimate) {
+              this.set_path_bounds(toolpath.estimate.bounds);
             }
           }
         } catch (error) {
@@ -394,6 +403,14 @@ module.exports = {
       }
     },
 
+    set_path_bounds: function (bounds) {
+      const state = this.$root.state;
+      for (const axis of "xyzabc") {
+        Vue.set(state, `path_min_${axis}`, bounds.min[axis]);
+        Vue.set(state, `path_max_${axis}`, bounds.max[axis]);
+      }
+    },
+
     submit_mdi: function () {
       this.send(this.mdi);
 
@@ -489,10 +506,15 @@ module.exports = {
       });
     },
 
+    // Compressed GCode is decompressed by the controller
+    gcode_name: function (filename) {
+      return filename.replace(/\.(gz|zst)$/i, "");
+    },
+
     validateFiles: async function (files) {
       const validFiles = [];
       for (const file of files) {
-        const extension = file.name.split(".").pop().toLowerCase();
+        const extension = this.gcode_name(file.name).split(".").pop().toLowerCase();
         const validExtensions = ["nc", "ngc", "gcode", "gc"];
 
         if (validExtensions.includes(extension)) {
@@ -514,20 +536,22 @@ module.exports = {
 
       for (const file of files) {
         try {
-          const gcode = await this.readFile(file);
+          const name = this.gcode_name(file.name);
+          const compressed = name != file.name;
+          const gcode = compressed ? file : await this.readFile(file);
           await this.upload_gcode(file.name, gcode);
 
-          const isAlreadyPresent = updatedConfig.non_macros_list.some(element => element.file_name === file.name);
+          const isAlreadyPresent = updatedConfig.non_macros_list.some(element => element.file_name === name);
 
           if (!isAlreadyPresent) {
-            updatedConfig.non_macros_list.push({ file_name: file.name });
+            updatedConfig.non_macros_list.push({ file_name: name });
           }
 
           if (folderName) {
             const folder = updatedConfig.gcode_list.find(item => item.type == "folder" && item.name == folderName);
             if (folder) {
-              if (!folder.files.map(item => item.file_name).includes(file.name)) {
-                folder.files.push({ file_name: file.name });
+              if (!folder.files.map(item => item.file_name).includes(name)) {
+                folder.files.push({ file_name: name });
               }
             } else {
               updatedConfig.gcode_list.push({
@@ -535,7 +559,7 @@ module.exports = {
                 type: "folder",
                 files: [
                   {
-                    file_name: file.name,
+                    file_name: name,
                   },
                 ],
               });
@@ -550,14 +574,14 @@ module.exports = {
                 type: "folder",
                 files: [
                   {
-                    file_name: file.name,
+                    file_name: name,
                   },
                 ],
               });
               folder_to_add = updatedConfig.gcode_list[0];
             }
-            if (!folder_to_add.files.find(item => item.file_name == file.name)) {
-              folder_to_add.files.push({ file_name: file.name });
+            if (!folder_to_add.files.find(item => item.file_name == name)) {
+              folder_to_add.files.push({ file_name: name });
             }
           }
         } catch (error) {
@@ -11,6 +11,11 @@ const entityMap = {
   "=": "&#x3D;",
 };
 
+// Lines loaded at a time and how close the current line may get to the edge
+// of the loaded lines before more are loaded
+const windowLines = 1000;
+const windowMargin = 100;
+
 function escapeHTML(s) {
   return s.replace(/[&<>"'`=\\/]/g, function (c) {
     return entityMap[c];
@@ -25,6 +30,9 @@ module.exports = {
       empty: true,
       file: "",
       line: -1,
+      start: 1,
+      total: 0,
+      loading: false,
     };
   },
 
@@ -51,6 +59,8 @@ module.exports = {
       no_data_text: "GCode view...",
       callbacks: { clusterChanged: this.highlight },
     });
+
+    this.$el.querySelector(".clusterize-scroll").addEventListener("scroll", this.scrolled);
   },
 
   attached: function () {
@@ -71,28 +81,85 @@ module.exports = {
         return;
       }
 
-      const response = await fetch(`/api/file/${file}`, { cache: "no-cache" });
-      const text = await response.text();
+      if (!(await this.load_window(1))) {
+        return;
+      }
 
-      if (text.length > 20e6) {
-        this.clusterize.update(["File is large - gcode view disabled"]);
-      } else {
-        const lines = escapeHTML(text.trimRight())
-          .split(/[\r\n]/)
-          .map((line, i) => `<li class="ln${i + 1}" contenteditable="true"><b>${i + 1}</b>${line}</li>`);
+      this.empty = false;
+
+      Vue.nextTick(this.update_line);
+    },
+
+    // Loads the lines from start up to the window size
+    load_window: async function (start) {
+      const file = this.file;
+      this.loading = true;
+
+      try {
+        const url = `/api/file/${encodeURIComponent(file)}/lines?start=${start}&count=${windowLines}`;
+        const response = await fetch(url, { cache: "no-cache" });
+        if (!response.ok) {
+          throw new Error(response.statusText);
+        }
+
+        const data = await response.json();
+        if (file != this.file) {
+          return false;
+        }
+
+        this.start = data.start;
+        this.total = data.total;
+
+        const lines = data.lines.map((line, i) => {
+          const n = data.start + i;
+          return `<li class="ln${n}" contenteditable="true"><b>${n}</b>${escapeHTML(line)}</li>`;
+        });
 
         this.clusterize.update(lines);
+
+        return true;
+      } catch (error) {
+        console.error("Failed to load GCode lines:", error);
+        return false;
+      } finally {
+        this.loading = false;
+      }
+    },
+
+    // Loads more lines when scrolled near the edge of those loaded
+    scrolled: async function () {
+      if (this.empty || this.loading) {
+        return;
       }
 
-      this.empty = false;
+      const scroll = this.$el.querySelector(".clusterize-scroll");
+      const rows = this.clusterize.getRowsAmount();
+      const lineHeight = scroll.scrollHeight / rows;
+      const first = this.start + Math.floor(scroll.scrollTop / lineHeight);
+      const last = first + Math.floor(scroll.clientHeight / lineHeight);
+      const end = this.start + rows - 1;
+
+      const before = 1 < this.start && first < this.start + windowMargin;
+      const after = end < this.total && end - windowMargin < last;
+      if (!before && !after) {
+        return;
+      }
 
-      Vue.nextTick(this.update_line);
+      const start = Math.max(1, Math.floor((first + last - windowLines) / 2));
+      if (!(await this.load_window(start))) {
+        return;
+      }
+
+      // Keep the same lines in view
+      scroll.scrollTop = (first - this.start) * lineHeight;
     },
 
     clear: function () {
       this.empty = true;
       this.file = "";
       this.line = -1;
+      this.start = 1;
+      this.total = 0;
       this.clusterize.clear();
     },
 
@@ -134,7 +201,22 @@ module.exports = {
         line = this.line;
       }
 
+      if (this.empty || this.loading) {
+        return;
+      }
+
       const totalLines = this.clusterize.getRowsAmount();
+      const end = this.start + totalLines - 1;
+
+      // Load the lines around the current line if near the edge
+      if ((1 < this.start && line < this.start + windowMargin) || (end < this.total && end - windowMargin < line)) {
+        const start = Math.max(1, line - windowLines / 2);
+        this.load_window(start).then(loaded => loaded && this.update_line());
+        return;
+      }
+
+      // Row of the line in those loaded
+      line -= this.start - 1;
 
       if (line <= 0) {
         line = 1;
@@ -0,0 +1,69 @@
+"use strict";
+
+// Decodes toolpath geometry written by PathFormat.py.  The header is
+// 'BBTP', uint8 version, uint8 flags, uint16 reserved, uint32 vertex count
+// and float64 resolution followed by zigzag varint position deltas and run
+// length encoded float32 speeds.
+const MAGIC = "BBTP";
+const VERSION = 1;
+const HEADER_SIZE = 20;
+
+function decode(buffer) {
+    const view = new DataView(buffer);
+    const bytes = new Uint8Array(buffer);
+
+    if (String.fromCharCode(...bytes.subarray(0, 4)) != MAGIC) {
+        throw new Error("Not a toolpath file");
+    }
+
+    const version = view.getUint8(4);
+    if (version != VERSION) {
+        throw new Error(`Unsupported toolpath version ${version}`);
+    }
+
+    const vertices = view.getUint32(8, true);
+    const resolution = view.getFloat64(12, true);
+    let offset = HEADER_SIZE;
+
+    // Avoids bitwise operators which truncate to 32 bits
+    function varint() {
+        let n = 0;
+        let scale = 1;
+
+        while (true) {
+            const b = bytes[offset++];
+            n += (b & 127) * scale;
+
+            if (b < 128) {
+                return n;
+            }
+
+            scale *= 128;
+        }
+    }
+
+    const positions = new Float32Array(vertices * 3);
+    const q = [ 0, 0, 0 ];
+
+    for (let i = 0; i < positions.length; i++) {
+        const n = varint();
+        const axis = i % 3;
+
+        q[axis] += n % 2 ? -(n + 1) / 2 : n / 2;
+        positions[i] = q[axis] * resolution;
+    }
+
+    const speeds = new Float32Array(vertices);
+    const runs = varint();
+
+    for (let i = 0, start = 0; i < runs; i++) {
+        const count = varint();
+        speeds.fill(view.getFloat32(offset, true), start, start + count);
+        offset += 4;
+        start += count;
+    }
+
+    return { positions, speeds };
+}
+
+module.exports = { decode };
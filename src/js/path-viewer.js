@@ -3,6 +3,28 @@
 const orbit = require("./orbit");
 const cookie = require("./cookie")("bbctrl-");
 const font = require("./helvetiker_regular.typeface.json");
+const pathFormat = require("./path-format");
+
+async function get_floats(url) {
+    const response = await fetch(url, { cache: "no-cache" });
+    const arrayBuffer = await response.arrayBuffer();
+
+    return new Float32Array(arrayBuffer);
+}
+
+async function get_path(url) {
+    const response = await fetch(url, { cache: "no-cache" });
+
+    return pathFormat.decode(await response.arrayBuffer());
+}
+
+function concat_floats(a, b) {
+    const result = new Float32Array(a.length + b.length);
+    result.set(a);
+    result.set(b, a.length);
+
+    return result;
+}
 
 module.exports = {
     template: "#path-viewer-template",
@@ -121,26 +143,134 @@ module.exports = {
                 return;
             }
 
-            async function get(url) {
-                const response = await fetch(`${url}`, { cache: "no-cache" });
-                const arrayBuffer = await response.arrayBuffer();
+            if (this.toolpath.partial) {
+                return this.update_partial();
+            }
+
+            this.partialFile = undefined;
 
-                return new Float32Array(arrayBuffer);
+            // Start with the coarsest level of detail
+            const lods = this.toolpath.lods || [];
+            const lod = lods.length ? lods.length - 1 : 0;
+            if (!await this.load_lod(this.toolpath, lod)) {
+                return;
             }
 
-            const [ positions, speeds ] = await Promise.all([
-                get(`/api/path/${this.toolpath.filename}/positions`),
-                get(`/api/path/${this.toolpath.filename}/speeds`)
-            ]);
+            this.loading = false;
+
+            // Update scene
+            this.scene = new THREE.Scene();
+            this.draw(this.scene);
+            this.snap(this.snapView);
+
+            this.update_view();
+            this.refine();
+        },
+
+        load_lod: async function(toolpath, lod) {
+            const url = `/api/path/${toolpath.filename}`;
+            const query = lod ? `?lod=${lod}` : "";
+            let positions, speeds;
+
+            if (toolpath.format) {
+                ({ positions, speeds } = await get_path(`${url}/path${query}`));
+
+            } else {
+                [ positions, speeds ] = await Promise.all([
+                    get_floats(`${url}/positions${query}`),
+                    get_floats(`${url}/speeds${query}`)
+                ]);
+            }
+
+            // Ignore stale responses
+            if (this.toolpath != toolpath) {
+                return false;
+            }
 
             this.positions = positions;
             this.speeds = speeds;
+            this.lod = lod;
+
+            return true;
+        },
+
+        get_pixel_size: function() {
+            // Size of one screen pixel in mm at the orbit target
+            const dist = this.camera.position.distanceTo(this.controls.target);
+            const height = 2 * dist * Math.tan(this.camera.fov / 360 * Math.PI);
+
+            return height / this.get_dims().height;
+        },
+
+        refine: async function() {
+            const toolpath = this.toolpath;
+            const lods = toolpath.lods;
+
+            if (!lods || this.refining || typeof this.lod == "undefined") {
+                return;
+            }
+
+            // Find the coarsest level which is still below one pixel
+            const pixel = this.get_pixel_size();
+            let lod = this.lod;
+            while (0 < lod && pixel < lods[lod].tolerance) {
+                lod--;
+            }
+
+            if (lod == this.lod) {
+                return;
+            }
+
+            this.refining = true;
+
+            try {
+                if (!await this.load_lod(toolpath, lod)) {
+                    return;
+                }
+
+                this.scene.remove(this.pathView);
+                this.pathView = this.draw_path(this.scene);
+                this.dirty = true;
+
+            } finally {
+                this.refining = false;
+            }
+
+            this.refine(); // The view may have changed while loading
+        },
+
+        update_partial: async function() {
+            const filename = this.toolpath.filename;
+            const first = this.partialFile != filename;
+
+            if (first) {
+                this.lod = undefined;
+                this.partialFile = filename;
+                this.positions = new Float32Array(0);
+                this.speeds = new Float32Array(0);
+            }
+
+            // Fetch only the vertices planned since the last update
+            const start = this.speeds.length;
+            const [ positions, speeds ] = await Promise.all([
+                get_floats(`/api/path/${filename}/positions?from=${start}`),
+                get_floats(`/api/path/${filename}/speeds?from=${start}`)
+            ]);
+
+            if (this.partialFile != filename || this.speeds.length != start) {
+                return;
+            }
+
+            const count = Math.min(positions.length / 3, speeds.length);
+            this.positions = concat_floats(this.positions, positions.subarray(0, count * 3));
+            this.speeds = concat_floats(this.speeds, speeds.subarray(0, count));
             this.loading = false;
 
-            // Update scene
             this.scene = new THREE.Scene();
             this.draw(this.scene);
-            this.snap(this.snapView);
+            if (first) {
+                this.snap(this.snapView);
+            }
 
             this.update_view();
         },
@@ -327,6 +457,7 @@ module.exports = {
                     fillLight.lookAt(scope.controls.target);
                     backLight.lookAt(scope.controls.target);
                     scope.dirty = true;
+                    scope.refine();
                 };
             }(this));
 
@@ -506,7 +637,7 @@ module.exports = {
             } // Rapid
 
             let intensity = speed / this.toolpath.maxSpeed;
-            if (typeof speed == "undefined" || !this.showIntensity) {
+            if (typeof speed == "undefined" || !this.showIntensity || !this.toolpath.maxSpeed) {
                 intensity = 1;
             }
 
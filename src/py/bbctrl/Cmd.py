@@ -29,6 +29,7 @@
 
 import struct
 import base64
+import binascii
 import json
 
 # Keep this in sync with AVR code command.def
@@ -61,24 +62,46 @@ SEEK_ACTIVE = 1 << 0
 SEEK_ERROR  = 1 << 1
 
 
+_float = struct.Struct('<f')
+
+# Recently encoded floats.  Moves repeat many values, max-accel and max-jerk
+# nearly always.
+_float_cache = {}
+FLOAT_CACHE_SIZE = 256
+
+
 def encode_float(x):
-    return base64.b64encode(struct.pack('<f', x))[:-2].decode("utf-8")
+    s = _float_cache.get(x)
+    if s is not None: return s
+
+    # Base64 of the 4 bytes is 6 characters, 2 padding and a newline
+    s = binascii.b2a_base64(_float.pack(x))[:6].decode()
+
+    # 0.0 and -0.0 are equal keys with different encodings
+    if x:
+        if FLOAT_CACHE_SIZE <= len(_float_cache): _float_cache.clear()
+        _float_cache[x] = s
+
+    return s
 
 
 def decode_float(s):
-    return struct.unpack('<f', base64.b64decode(s + '=='))[0]
+    return _float.unpack(base64.b64decode(s + '=='))[0]
 
 
-def encode_axes(axes):
-    data = ''
+def _encode_axes(parts, axes):
     for axis in 'xyzabc':
         if axis in axes:
-            data += axis + encode_float(axes[axis])
+            parts += (axis, encode_float(axes[axis]))
 
         elif axis.upper() in axes:
-            data += axis + encode_float(axes[axis.upper()])
+            parts += (axis, encode_float(axes[axis.upper()]))
 
-    return data
+
+def encode_axes(axes):
+    parts = []
+    _encode_axes(parts, axes)
+    return ''.join(parts)
 
 
 def set_sync(name, value):
@@ -101,23 +124,20 @@ def set_axis(axis, position): return SET_AXIS + axis + encode_float(position)
 
 
 def line(target, exitVel, maxAccel, maxJerk, times, speeds):
-    cmd = LINE
-
-    cmd += encode_float(exitVel)
-    cmd += encode_float(maxAccel)
-    cmd += encode_float(maxJerk)
-    cmd += encode_axes(target)
+    parts = [LINE, encode_float(exitVel), encode_float(maxAccel),
+             encode_float(maxJerk)]
+    _encode_axes(parts, target)
 
     # S-Curve time parameters
     for i in range(7):
         if times[i]:
-            cmd += str(i) + encode_float(times[i] / 60000) # to mins
+            parts += ('0123456'[i], encode_float(times[i] / 60000)) # to mins
 
     # Speeds
     for dist, speed in speeds:
-        cmd += '\n' + sync_speed(dist, speed)
+        parts += ('\n', SYNC_SPEED, encode_float(dist), encode_float(speed))
 
-    return cmd
+    return ''.join(parts)
 
 
 def speed(value): return SPEED + encode_float(value)
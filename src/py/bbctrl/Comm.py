@@ -49,6 +49,10 @@ DRV8711_COMM_ERROR_bm    = 1 << 8
 # Ignoring stall and stall latch flags for now
 DRV8711_MASK = ~(DRV8711_STATUS_STD_bm | DRV8711_STATUS_STDLAT_bm)
 
+# Commands are batched into writes of about this many bytes, the size of the
+# kernel's serial transmit buffer
+WRITE_BATCH = 4096
+
 
 def _driver_flags_to_string(flags):
     if DRV8711_STATUS_OTS_bm    & flags: yield 'over temp'
@@ -72,10 +76,17 @@ class Comm(object):
         self.avr = avr
         self.log = self.ctrl.log.get('Comm')
         self.queue = deque()
-        self.in_buf = ''
-        self.command = None
+        self.in_buf = bytearray()
+        self.out_buf = bytearray()
+        self.partial = False # The first command in out_buf is partly written
         self.last_motor_flags = [0] * 4
 
+        # Serial write counters
+        self.bytes_written = 0
+        self.cmds_written = 0
+        self.writes = 0
+        self.last_rate = (time.time(), 0, 0, 0)
+
         avr.set_handlers(self._read, self._write)
         self._poll_cb(False)
 
@@ -84,7 +95,7 @@ class Comm(object):
     def comm_error(self): raise Exception('Not implemented')
 
 
-    def is_active(self): return len(self.queue) or self.command is not None
+    def is_active(self): return len(self.queue) or len(self.out_buf)
 
 
     def i2c_command(self, cmd, byte = None, word = None, block = None):
@@ -95,9 +106,18 @@ class Comm(object):
     def flush(self): self.avr.enable_write(True)
 
 
+    def clear_output(self):
+        # Drop commands not yet written, except the rest of one partly written
+        if self.partial: del self.out_buf[self.out_buf.index(b'\n') + 1:]
+        else: self.out_buf.clear()
+
+
     def _load_next_command(self, cmd):
-        self.log.info('< ' + json.dumps(cmd).strip('"'))
-        self.command = bytes(cmd.strip() + '\n', 'utf-8')
+        self.ctrl.trace.add('<', cmd)
+        if self.ctrl.args.log_commands:
+            self.log.info('< ' + json.dumps(cmd).strip('"'))
+        self.out_buf += bytes(cmd.strip() + '\n', 'utf-8')
+        self.cmds_written += 1
 
 
     def resume(self): self.queue_command(Cmd.RESUME)
@@ -108,35 +128,58 @@ class Comm(object):
         self.flush()
 
 
+    def _report_rates(self):
+        now = time.time()
+        last, bytes_written, cmds_written, writes = self.last_rate
+        delta = max(now - last, 0.001)
+
+        self.ctrl.state.set('serial_bytes_per_sec',
+                            round((self.bytes_written - bytes_written) / delta))
+        self.ctrl.state.set('serial_cmds_per_sec',
+                            round((self.cmds_written - cmds_written) / delta))
+        self.ctrl.state.set('serial_writes_per_sec',
+                            round((self.writes - writes) / delta))
+
+        self.last_rate = (now, self.bytes_written, self.cmds_written,
+                          self.writes)
+
+
     def _poll_cb(self, now = True):
         # Checks periodically for new commands from planner via comm_next()
-        if now: self.flush()
+        if now:
+            self.flush()
+            self._report_rates()
+
         self.ctrl.ioloop.call_later(1, self._poll_cb)
 
 
     def _write(self, write_cb):
-        # Finish writing current command
-        if self.command is not None:
-            try:
-                count = write_cb(self.command)
+        # Batch commands from the queue, then the callback, into one write
+        while len(self.out_buf) < WRITE_BATCH:
+            if len(self.queue): cmd = self.queue.popleft()
+            else:
+                cmd = self.comm_next() # pylint: disable=assignment-from-no-return
+                if cmd is None: break
 
-            except Exception as e:
-                self.command = None
-                raise e
+            self._load_next_command(cmd)
 
-            self.command = self.command[count:]
-            if len(self.command): return # There's more
-            self.command = None
+        if not len(self.out_buf):
+            self.avr.enable_write(False) # Stop writing
+            return
 
-        # Load next command from queue
-        if len(self.queue): self._load_next_command(self.queue.popleft())
+        try:
+            count = write_cb(bytes(self.out_buf))
 
-        # Load next command from callback
-        else:
-            cmd = self.comm_next() # pylint: disable=assignment-from-no-return
+        except Exception as e:
+            self.out_buf.clear()
+            self.partial = False
+            raise e
 
-            if cmd is None: self.avr.enable_write(False) # Stop writing
-            else: self._load_next_command(cmd)
+        # Keep whatever was not written for next time
+        if count: self.partial = self.out_buf[count - 1] != ord('\n')
+        del self.out_buf[:count]
+        self.bytes_written += count
+        self.writes += 1
 
 
     def _update_vars(self, msg):
@@ -165,7 +208,9 @@ class Comm(object):
         elif level == 'warning': self.log.warning(msg, where = where)
         elif level == 'error':   self.log.error(msg,   where = where)
 
-        if level == 'error': self.comm_error()
+        if level == 'error':
+            self.ctrl.trace.dump('AVR error')
+            self.comm_error()
 
         # Treat machine alarmed warning as an error
         if level == 'warning' and 'code' in msg and msg['code'] == 11:
@@ -197,17 +242,22 @@ class Comm(object):
 
 
     def _read(self, data):
-        self.in_buf += data.decode('utf-8')
+        buf = self.in_buf
+        buf += data
+        start = 0
+        updates = {}
 
-        # Parse incoming serial data into lines
-        while True:
-            i = self.in_buf.find('\n')
-            if i == -1: break
-            line = self.in_buf[0:i].strip()
-            self.in_buf = self.in_buf[i + 1:]
+        # Parse incoming serial data into lines without copying the buffer
+        try:
+            while True:
+                end = buf.find(b'\n', start)
+                if end == -1: break
+                line = buf[start:end].strip()
+                start = end + 1
 
-            if line:
-                self.log.info('> ' + line)
+                if not line: continue
+                line = line.decode('utf-8', 'replace')
+                self.ctrl.trace.add('>', line)
 
                 try:
                     msg = json.loads(line)
@@ -216,16 +266,33 @@ class Comm(object):
                     self.log.warning('%s, data: %s', e, line)
                     continue
 
+                # Fast path for state updates, merged into a single update
+                if not ('variables' in msg or 'msg' in msg or
+                        'firmware' in msg):
+                    self.log.debug('> ' + line)
+                    updates.update(msg)
+                    continue
+
+                self.log.info('> ' + line)
+
+                # Apply updates received before this message first
+                if updates:
+                    self._update_state(updates)
+                    updates = {}
+
                 if 'variables' in msg:
                     self._update_vars(msg)
                 elif 'msg' in msg:
                     self._log_msg(msg)
                     self.ctrl.mach.process_log(msg)
-                elif 'firmware' in msg:
+                else:
                     self.log.info('AVR firmware rebooted')
                     self.connect()
-                else:
-                    self._update_state(msg)
+
+        finally:
+            del buf[:start]
+
+        if updates: self._update_state(updates)
 
 
     def estop(self):
@@ -114,14 +114,14 @@ class Config(object):
 
         os.sync()
 
-        self.ctrl.preplanner.invalidate_all()
+        self.ctrl.preplanner.update_config()
         self.log.info('Saved')
 
 
     def reset(self):
         if os.path.exists('config.json'): os.unlink('config.json')
         self.reload()
-        self.ctrl.preplanner.invalidate_all()
+        self.ctrl.preplanner.update_config()
 
 
     def _valid_value(self, template, value):
@@ -46,6 +46,7 @@ class Ctrl(object):
 
         self.state = bbctrl.State(self)
         self.config = bbctrl.Config(self)
+        self.trace = bbctrl.Trace(self)
 
         self.log.get('Ctrl').info('Starting %s' % self.id)
 
@@ -114,3 +115,4 @@ class Ctrl(object):
         self.ioloop.close()
         self.avr.close()
         self.mach.planner.close()
+        self.preplanner.close()
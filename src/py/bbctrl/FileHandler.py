@@ -1,11 +1,11 @@
 import os
-import tempfile
 import bbctrl
 import glob
 import tornado
 from tornado import gen
 from tornado.web import HTTPError
 from tornado.escape import url_unescape
+from bbctrl.Upload import get_encoding
 
 
 def safe_remove(path):
@@ -30,11 +30,31 @@ class FileHandler(bbctrl.APIHandler):
                 .replace('#', '-') \
                 .replace('?', '-')
 
-            self.uploadFile = tempfile.NamedTemporaryFile("wb")
+            # Compressed uploads are saved decompressed
+            encoding, self.uploadFilename = get_encoding(
+                self.uploadFilename,
+                self.request.headers.get('Content-Encoding'))
+
+            try:
+                self.upload = bbctrl.Upload(self.get_ctrl(),
+                                            self.uploadFilename, encoding)
+            except Exception as e: raise HTTPError(415, str(e))
 
     def data_received(self, data):
         if self.request.method == 'PUT':
-            self.uploadFile.write(data)
+            return self.upload.write(data)
+
+    @gen.coroutine
+    def put(self, *args, **kwargs):
+        yield self.upload.flush()
+        super().put(*args, **kwargs)
+
+    def _close_upload(self):
+        # Discard an upload which failed or was cut off
+        if hasattr(self, 'upload'): self.upload.close()
+
+    def on_connection_close(self): self._close_upload()
+    def on_finish(self): self._close_upload()
 
     def delete_ok(self, filename):
         allFiles = self.get_ctrl().state.return_files()
@@ -81,25 +101,23 @@ class FileHandler(bbctrl.APIHandler):
             self.uploadFilename=self.uploadFilename.replace('EgZjaHJvbWUqCggBEAAYsQMYgAQyBggAEEUYOTIKCAE','')
             filename = self.get_upload(self.uploadFilename).encode('utf8')
             safe_remove(filename)
-            os.link(self.uploadFile.name, filename)
+            self.upload.save(filename)
 
-            self.uploadFile.close()
+            self.get_ctrl().preplanner.add_upload(self.uploadFilename,
+                                                  self.upload)
+            del (self.upload)
 
-            del (self.uploadFile)
-
-            self.get_ctrl().preplanner.invalidate(self.uploadFilename)
             self.get_ctrl().state.add_file('EgZjaHJvbWUqCggBEAAYsQMYgAQyBggAEEUYOTIKCAE'+self.uploadFilename)
 
         else:
             filename = self.get_upload(self.uploadFilename).encode('utf8')
             safe_remove(filename)
-            os.link(self.uploadFile.name, filename)
-
-            self.uploadFile.close()
+            self.upload.save(filename)
 
-            del (self.uploadFile)
+            self.get_ctrl().preplanner.add_upload(self.uploadFilename,
+                                                  self.upload)
+            del (self.upload)
 
-            self.get_ctrl().preplanner.invalidate(self.uploadFilename)
             self.get_ctrl().state.add_file(self.uploadFilename)
 
         del (self.uploadFilename)
@@ -115,11 +133,19 @@ class FileHandler(bbctrl.APIHandler):
             filebasename = os.path.basename(url_unescape(filename))
         
         try:
-            with open(self.get_upload(filebasename).encode('utf8'), 'r') as f:
-                self.write(f.read())
+            f = open(self.get_upload(filebasename).encode('utf8'), 'rb')
         except Exception:
             self.get_ctrl().state.select_file('')
             raise HTTPError(
                 400, "Unable to read file - doesn't appear to be GCode.")
         if not filename.startswith('/EgZjaHJvbWUqCggBEAAYsQMYgAQyBggAEEUYOTIKCAE'):
             self.get_ctrl().state.select_file(filebasename)
+
+        with f:
+            # Uploads are replaced, not modified, so the inode and mtime
+            # identify the content
+            st = os.fstat(f.fileno())
+            etag = '"%x-%x-%x"' % (st.st_ino, st.st_size, st.st_mtime_ns)
+            if self.check_etag(etag): return
+
+            yield self.send_file(f, st.st_size)
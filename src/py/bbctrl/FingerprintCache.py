@@ -0,0 +1,300 @@
+################################################################################
+#                                                                              #
+#                This file is part of the Buildbotics firmware.                #
+#                                                                              #
+#                  Copyright (c) 2015 - 2018, Buildbotics LLC                  #
+#                             All rights reserved.                             #
+#                                                                              #
+#     This file ("the software") is free software: you can redistribute it     #
+#     and/or modify it under the terms of the GNU General Public License,      #
+#      version 2 as published by the Free Software Foundation. You should      #
+#      have received a copy of the GNU General Public License, version 2       #
+#     along with the software. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                              #
+#     The software is distributed in the hope that it will be useful, but      #
+#          WITHOUT ANY WARRANTY; without even the implied warranty of          #
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU       #
+#               Lesser General Public License for more details.                #
+#                                                                              #
+#       You should have received a copy of the GNU Lesser General Public       #
+#                License along with the software.  If not, see                 #
+#                       <http://www.gnu.org/licenses/>.                        #
+#                                                                              #
+#                For information regarding this software email:                #
+#                  "Joseph Coffland" <joseph@buildbotics.com>                  #
+#                                                                              #
+################################################################################
+
+import os
+import json
+import array
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from tornado import gen
+
+
+# Lines between entries of the line offset index
+LINE_INDEX_STEP = 1024
+
+
+def skip_lines(data, pos, n, width = 64):
+    # Returns the offset after the nth newline from pos, which must exist.
+    # Narrowed down with bytes.count() rather than finding each newline,
+    # starting from a guess of width bytes per line.
+    end = pos
+    step = n * width * 5 // 4 + 64
+
+    while True:
+        pos, end = end, min(end + step, len(data))
+        count = data.count(b'\n', pos, end)
+        if n <= count: break
+        n -= count
+
+    # The nth newline is in [pos, end)
+    while 1 < end - pos:
+        mid = (pos + end) // 2
+        count = data.count(b'\n', pos, mid)
+
+        if count < n:
+            n -= count
+            pos = mid
+
+        else: end = mid
+
+    return end
+
+
+# Computes the SHA-256, line count and line offset index of data fed in any
+# size pieces.  Index entry k is the byte offset of line k * LINE_INDEX_STEP + 1.
+class Fingerprint(object):
+    def __init__(self):
+        self.hash = hashlib.sha256()
+        self.lines = 0
+        self.offset = 0
+        self.index = [0]
+        self.last = b'\n'
+
+
+    def update(self, data):
+        if not data: return
+        self.hash.update(data)
+        count = data.count(b'\n')
+
+        # Newlines in data before the next index entry
+        need = len(self.index) * LINE_INDEX_STEP - self.lines
+        pos = 0
+
+        while need <= count:
+            width = (self.offset + pos) // (self.lines + 1) + 1
+            pos = skip_lines(data, pos, need, width)
+            self.index.append(self.offset + pos)
+            self.lines += need
+            count -= need
+            need = LINE_INDEX_STEP
+
+        self.lines += count
+        self.offset += len(data)
+        self.last = data[-1:]
+
+
+    def result(self):
+        lines = self.lines
+        if self.last != b'\n': lines += 1 # Last line not terminated
+
+        return dict(hash = self.hash.hexdigest(), lines = lines,
+                    index = self.index)
+
+
+# Returns the SHA-256 and line count of a file in a single pass
+def fingerprint(path):
+    fp = Fingerprint()
+
+    with open(path, 'rb') as f:
+        while True:
+            buf = f.read(1024 * 1024)
+            if not buf: break
+            fp.update(buf)
+
+    return fp.result()
+
+
+def read_lines(path, index, start, count):
+    # Returns up to count lines from line start using a line offset index
+    k = min((start - 1) // LINE_INDEX_STEP, len(index) - 1)
+    lines = []
+
+    with open(path, 'rb') as f:
+        f.seek(index[k])
+        for i in range(start - 1 - k * LINE_INDEX_STEP):
+            if not f.readline(): return lines
+
+        for i in range(count):
+            line = f.readline()
+            if not line: break
+            lines.append(line.rstrip(b'\r\n').decode('utf8', 'replace'))
+
+    return lines
+
+
+def stat_key(path):
+    st = os.stat(path)
+    return '%d:%d:%d:%d' % (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+# Persistent cache of file content hashes and line counts.  Entries are keyed
+# by device, inode, size and modification time so unchanged files are never
+# read twice.  Misses are computed in a thread to keep large files from
+# stalling the ioloop.  Line offset indices are kept in a file per content
+# hash so the entries stay small.
+class FingerprintCache(object):
+    def __init__(self, ctrl, max_entries = 1000):
+        self.ctrl = ctrl
+        self.log = ctrl.log.get('Preplanner')
+        self.max_entries = max_entries
+        self.path = ctrl.get_path('fingerprints.json')
+        self.index_dir = ctrl.get_path('fingerprints')
+        self.executor = ThreadPoolExecutor(1)
+        self.pending = {}
+        self.save_timeout = None
+        self.entries = OrderedDict()
+        self.indices = OrderedDict() # Recently used line offset indices
+
+        if not os.path.exists(self.index_dir): os.mkdir(self.index_dir)
+
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, 'r') as f:
+                    # Indices stored in the entries before are dropped
+                    self.entries.update(
+                        (key, dict(hash = fp['hash'], lines = fp['lines']))
+                        for key, fp in json.load(f).items())
+
+        except Exception as e:
+            self.log.warning('Failed to load file fingerprints: %s', e)
+
+
+    def _index_path(self, hash):
+        return os.path.join(self.index_dir, hash + '.idx')
+
+
+    def _write_index(self, hash, index):
+        # Runs in the executor
+        path = self._index_path(hash)
+        with open(path + '.tmp', 'wb') as f: array.array('Q', index).tofile(f)
+        os.rename(path + '.tmp', path)
+
+
+    def _read_index(self, hash):
+        index = array.array('Q')
+
+        try:
+            with open(self._index_path(hash), 'rb') as f:
+                index.frombytes(f.read())
+                return index.tolist()
+
+        except FileNotFoundError: pass
+
+
+    def _write(self, entries):
+        # Runs in the executor
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f: json.dump(entries, f)
+        os.rename(tmp, self.path)
+
+        # Remove indices of forgotten files
+        hashes = set(fp['hash'] for fp in entries.values())
+
+        for name in os.listdir(self.index_dir):
+            if name.endswith('.idx') and not name[:-4] in hashes:
+                try:
+                    os.unlink(os.path.join(self.index_dir, name))
+                except OSError: pass
+
+
+    def _save(self):
+        self.save_timeout = None
+
+        while self.max_entries < len(self.entries):
+            self.entries.popitem(last = False)
+
+        return self.executor.submit(self._write, dict(self.entries))
+
+
+    def _save_later(self):
+        if self.save_timeout is None:
+            self.save_timeout = self.ctrl.ioloop.call_later(5, self._save)
+
+
+    def _remember_index(self, hash, index):
+        self.indices[hash] = index
+        self.indices.move_to_end(hash)
+        while 8 < len(self.indices): self.indices.popitem(last = False)
+
+
+    def _add(self, key, result):
+        self.entries[key] = dict(hash = result['hash'], lines = result['lines'])
+        self._remember_index(result['hash'], result['index'])
+        self.executor.submit(self._write_index, result['hash'], result['index'])
+        self._save_later()
+
+
+    def lookup(self, path):
+        # Returns the cached fingerprint or None without reading the file
+        key = stat_key(path)
+
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+
+    def add(self, path, result):
+        # Record a fingerprint computed while the file was written
+        self._add(stat_key(path), result)
+
+
+    @gen.coroutine
+    def get(self, path):
+        key = stat_key(path)
+
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+        if not key in self.pending:
+            self.pending[key] = self.executor.submit(fingerprint, path)
+
+        try:
+            result = yield self.pending[key]
+        finally:
+            self.pending.pop(key, None)
+
+        # Only cache if the file did not change while being read
+        if stat_key(path) == key: self._add(key, result)
+
+        return result
+
+
+    @gen.coroutine
+    def get_index(self, path):
+        # Returns the fingerprint and line offset index of a file
+        fp = yield self.get(path)
+        index = self.indices.get(fp['hash'])
+        if index is None: index = self._read_index(fp['hash'])
+
+        if index is None:
+            # Index lost, compute it again
+            result = yield self.executor.submit(fingerprint, path)
+            if stat_key(path) in self.entries: self._add(stat_key(path), result)
+            return result, result['index']
+
+        self._remember_index(fp['hash'], index)
+        return fp, index
+
+
+    def close(self):
+        if self.save_timeout is not None:
+            self.ctrl.ioloop.remove_timeout(self.save_timeout)
+            self._save().result()
+
+        self.executor.shutdown(wait = False)
@@ -0,0 +1,247 @@
+################################################################################
+#                                                                              #
+#                This file is part of the Buildbotics firmware.                #
+#                                                                              #
+#                  Copyright (c) 2015 - 2018, Buildbotics LLC                  #
+#                             All rights reserved.                             #
+#                                                                              #
+#     This file ("the software") is free software: you can redistribute it     #
+#     and/or modify it under the terms of the GNU General Public License,      #
+#      version 2 as published by the Free Software Foundation. You should      #
+#      have received a copy of the GNU General Public License, version 2       #
+#     along with the software. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                              #
+#     The software is distributed in the hope that it will be useful, but      #
+#          WITHOUT ANY WARRANTY; without even the implied warranty of          #
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU       #
+#               Lesser General Public License for more details.                #
+#                                                                              #
+#       You should have received a copy of the GNU Lesser General Public       #
+#                License along with the software.  If not, see                 #
+#                       <http://www.gnu.org/licenses/>.                        #
+#                                                                              #
+#                For information regarding this software email:                #
+#                  "Joseph Coffland" <joseph@buildbotics.com>                  #
+#                                                                              #
+################################################################################
+
+import os
+import re
+import math
+
+
+# A single pass over the GCode text which estimates the program's bounds and
+# run time in a fraction of the time a full plan takes.  Moves are assumed to
+# run at the programmed feed rate, rapids at the axis velocity limits and
+# expressions, subroutines and offset changes are not evaluated so results
+# are only provisional.
+
+reWord = re.compile(r'([A-Z])\s*([-+]?[0-9]*\.?[0-9]*)')
+reComment = re.compile(r'\([^)]*\)|;.*$')
+
+# Codes listed as unimplemented on the cheat sheet
+unsupported = set('''
+  G5 G5.1 G5.2 G5.3 G7 G8 G33 G33.1 G41 G41.1 G42 G42.1 G73 G76 G83 G95 G96
+  G98 G99 M19 M48 M49 M50 M51 M52 M53 M60 M61 M62 M63 M64 M65 M66 M67 M68
+'''.split())
+
+# Codes which do not move along the programmed axis words
+non_motion = set(('4', '10', '28', '28.1', '30', '30.1', '92'))
+
+MAX_WARNINGS = 20
+
+
+def format_code(letter, number):
+    return letter + ('%.1f' % number).rstrip('0').rstrip('.')
+
+
+def arc_points(center, radius, a0, sweep, clockwise):
+    # Points where the arc crosses the plane axes
+    for k in range(4):
+        angle = k * math.pi / 2
+        offset = (a0 - angle if clockwise else angle - a0) % (2 * math.pi)
+
+        if offset <= sweep:
+            yield (center[0] + radius * math.cos(angle),
+                   center[1] + radius * math.sin(angle))
+
+
+def arc_center(start, end, words, plane, clockwise, scale):
+    # Returns the arc center from I, J, K offsets or R
+    if 'R' not in words:
+        offsets = [words.get(plane[3], 0) * scale,
+                   words.get(plane[4], 0) * scale]
+        return start[0] + offsets[0], start[1] + offsets[1]
+
+    r = words['R'] * scale
+    dx, dy = end[0] - start[0], end[1] - start[1]
+    d = math.hypot(dx, dy)
+    if not d or 2 * abs(r) < d: return
+
+    h = math.sqrt(r * r - d * d / 4)
+    if clockwise == (0 < r): h = -h
+
+    return ((start[0] + end[0]) / 2 - h * dy / d,
+            (start[1] + end[1]) / 2 + h * dx / d)
+
+
+# Plane axis indices followed by the matching arc center offset words
+planes = {
+    '17': (0, 1, 2, 'I', 'J'),
+    '18': (2, 0, 1, 'K', 'I'),
+    '19': (1, 2, 0, 'J', 'K'),
+}
+
+
+def scan(path, offsets = {}, max_vel = {}, metric = True):
+    with open(path, 'r', errors = 'replace') as f:
+        return scan_lines(f, os.path.basename(path), offsets, max_vel, metric)
+
+
+def scan_lines(lines, filename, offsets = {}, max_vel = {}, metric = True):
+    offset = [offsets.get(axis, 0) for axis in 'xyz']
+    vel = [max_vel.get(axis) for axis in 'xyz']
+    position = [None] * 3
+    lo = [math.inf] * 3
+    hi = [-math.inf] * 3
+    codeCache = {}
+    tools = set()
+    messages = []
+    warned = set()
+    count = 0
+    time = 0
+    maxSpeed = 0
+    scale = 1 if metric else 25.4
+    absolute = True
+    inverse = False
+    motion = None
+    plane = planes['17']
+    feed = 0
+    ended = False
+
+    def warn(line, msg):
+        if msg in warned or MAX_WARNINGS <= len(warned): return
+        warned.add(msg)
+        messages.append(dict(level = 'warning', msg = msg,
+                             filename = filename, line = line, column = None))
+
+    for text in lines:
+        count += 1
+        if ended: continue
+
+        text = reComment.sub('', text.upper()).strip()
+        if not text: continue
+
+        if text[0] == 'O':
+            warn(count, 'Subroutines are not included in the estimate')
+            continue
+
+        words = {}
+        codes = []
+
+        for letter, value in reWord.findall(text):
+            if letter == 'G' or letter == 'M':
+                key = letter + value
+                code = codeCache.get(key)
+
+                if code is None:
+                    try:
+                        name = format_code(letter, float(value))
+                    except ValueError: name = ''
+
+                    if (name in unsupported or
+                        (letter == 'M' and 100 < float(value or 0) < 200)):
+                        warn(count, 'Unsupported GCode %s' % name)
+
+                    # G codes are stored without the letter
+                    code = name[1:] if letter == 'G' else name
+                    codeCache[key] = code
+
+                codes.append(code)
+                continue
+
+            try:
+                words[letter] = float(value)
+            except ValueError:
+                warn(count, 'Expressions are not included in the estimate')
+
+        machine = False
+        moves = True
+
+        for code in codes:
+            if code in ('0', '1', '2', '3'): motion = code
+            elif code == '80': motion = None
+            elif code in ('20', '21'): scale = 1 if code == '21' else 25.4
+            elif code in ('90', '91'): absolute = code == '90'
+            elif code in ('93', '94'): inverse = code == '93'
+            elif code in planes: plane = planes[code]
+            elif code == '53': machine = True
+            elif code in ('M2', 'M30'): ended = True
+            elif code in non_motion: moves = False
+
+            if code == '4': time += words.get('P', 0)
+
+        if 'F' in words: feed = words['F'] * (1 if inverse else scale)
+        if 'S' in words: maxSpeed = max(maxSpeed, words['S'])
+        if 'T' in words: tools.add(int(words['T']))
+
+        if not moves or motion is None: continue
+
+        # Machine coordinate targets, axes not yet positioned are assumed
+        # not to move
+        start = position[:]
+        delta = [0, 0, 0]
+
+        for i, letter in enumerate('XYZ'):
+            if letter not in words: continue
+            value = words[letter] * scale
+
+            if not absolute and position[i] is not None:
+                value += position[i]
+            elif not machine: value += offset[i]
+
+            if position[i] is not None: delta[i] = value - position[i]
+            position[i] = value
+            if value < lo[i]: lo[i] = value
+            if hi[i] < value: hi[i] = value
+
+        if motion == '0':
+            # Each axis moves at up to its own velocity limit
+            time += max([abs(delta[i]) / vel[i] * 60
+                         for i in range(3) if vel[i]] + [0])
+            continue
+
+        length = math.sqrt(delta[0] ** 2 + delta[1] ** 2 + delta[2] ** 2)
+
+        if motion == '2' or motion == '3':
+            a, b, c = plane[:3]
+            s = (start[a] or 0, start[b] or 0)
+            e = (position[a] or 0, position[b] or 0)
+            clockwise = motion == '2'
+            center = arc_center(s, e, words, plane, clockwise, scale)
+
+            if center is not None:
+                radius = math.hypot(s[0] - center[0], s[1] - center[1])
+                a0 = math.atan2(s[1] - center[1], s[0] - center[0])
+                a1 = math.atan2(e[1] - center[1], e[0] - center[0])
+                sweep = (a0 - a1 if clockwise else a1 - a0) % (2 * math.pi)
+                if not sweep: sweep = 2 * math.pi # Full circle
+
+                for x, y in arc_points(center, radius, a0, sweep,
+                                       clockwise):
+                    lo[a], hi[a] = min(lo[a], x), max(hi[a], x)
+                    lo[b], hi[b] = min(lo[b], y), max(hi[b], y)
+
+                length = math.hypot(radius * sweep, delta[c])
+
+        if inverse: time += 60 / feed if feed else 0
+        elif feed: time += length / feed * 60
+
+    bounds = dict(min = {}, max = {})
+    for i, axis in enumerate('xyz'):
+        if lo[i] <= hi[i]:
+            bounds['min'][axis] = lo[i]
+            bounds['max'][axis] = hi[i]
+
+    return dict(lines = count, time = time, maxSpeed = maxSpeed,
+                bounds = bounds, tools = sorted(tools), messages = messages)
@@ -28,6 +28,7 @@
 import bbctrl
 from bbctrl.Comm import Comm
 import bbctrl.Cmd as Cmd
+from tornado import gen
 
 
 # Axis homing procedure:
@@ -159,7 +160,9 @@ class Mach(Comm):
 
         # Handle EStop
         if state_changed and state == 'ESTOPPED':
+            self.ctrl.trace.dump('estop')
             self.planner.reset(stop = False)
+            super().clear_output()
 
         # Exit cycle if state changed to READY
         if (state_changed and self._get_cycle() != 'idle' and
@@ -224,11 +227,13 @@ class Mach(Comm):
     @overrides(Comm)
     def comm_error(self):
         self.planner.reset()
+        super().clear_output()
 
 
     @overrides(Comm)
     def connect(self):
         self.planner.reset()
+        super().clear_output()
         super().connect()
 
 
@@ -317,7 +322,11 @@ class Mach(Comm):
 
 
     def unhome(self, axis): self.mdi('G28.2 %c0' % axis)
-    def estop(self): super().estop()
+
+
+    def estop(self):
+        super().estop()
+        super().clear_output() # Moves encoded before the estop
 
 
     def clear(self):
@@ -326,11 +335,33 @@ class Mach(Comm):
             super().clear()
 
 
-    def start(self):
+    @gen.coroutine
+    def start(self, from_line = None):
         filename = self.ctrl.state.get('selected', '')
         if not filename: return
+        preplanner = self.ctrl.preplanner
+        checkpoint = resume = None
+
+        # Refuse before moving rather than failing part way through
+        errors = preplanner.check_limits(filename)
+        if errors: raise Exception('Program exceeds soft limits: ' +
+                                   ', '.join(errors))
+
+        if from_line is not None and 1 < from_line:
+            checkpoint = preplanner.get_checkpoint(filename, from_line)
+
+            if checkpoint is None:
+                raise Exception('Cannot start from line %d, no checkpoint '
+                                'found.  Wait for planning to finish.' %
+                                from_line)
+
+            resume = yield self.planner.write_resume(filename, checkpoint)
+
+            if self.ctrl.state.get('selected', '') != filename:
+                raise Exception('Selected file changed while resuming')
+
         self._begin_cycle('running')
-        self.planner.load(filename)
+        self.planner.load(filename, checkpoint, resume)
         super().resume()
 
 
@@ -0,0 +1,209 @@
+################################################################################
+#                                                                              #
+#                This file is part of the Buildbotics firmware.                #
+#                                                                              #
+#                  Copyright (c) 2015 - 2018, Buildbotics LLC                  #
+#                             All rights reserved.                             #
+#                                                                              #
+#     This file ("the software") is free software: you can redistribute it     #
+#     and/or modify it under the terms of the GNU General Public License,      #
+#      version 2 as published by the Free Software Foundation. You should      #
+#      have received a copy of the GNU General Public License, version 2       #
+#     along with the software. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                              #
+#     The software is distributed in the hope that it will be useful, but      #
+#          WITHOUT ANY WARRANTY; without even the implied warranty of          #
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU       #
+#               Lesser General Public License for more details.                #
+#                                                                              #
+#       You should have received a copy of the GNU Lesser General Public       #
+#                License along with the software.  If not, see                 #
+#                       <http://www.gnu.org/licenses/>.                        #
+#                                                                              #
+#                For information regarding this software email:                #
+#                  "Joseph Coffland" <joseph@buildbotics.com>                  #
+#                                                                              #
+################################################################################
+
+import gzip
+import struct
+import operator
+import functools
+import itertools
+from array import array
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Compact toolpath geometry, all values little endian:
+#
+#   header     'BBTP', uint8 version, uint8 flags, uint16 reserved,
+#              uint32 vertex count, float64 resolution in mm
+#   positions  Per vertex, the x, y and z deltas from the previous vertex in
+#              units of resolution as zigzag varints
+#   speeds     Varint run count then per run a varint vertex count and a
+#              float32 speed, NaN for rapids
+#
+# Line times are the planned time in seconds at the start of selected GCode
+# lines, used to look up progress from the current line:
+#
+#   header     'BBLT', uint8 version, uint32 entry count
+#   lines      uint32 line numbers, ascending
+#   times      float32 cumulative seconds
+#
+# Files are stored zstd compressed if available, otherwise gzip, and are
+# served with a matching Content-Encoding.
+
+MAGIC = b'BBTP'
+VERSION = 1
+RESOLUTION = 0.001 # mm
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+TIMES_MAGIC = b'BBLT'
+TIMES_VERSION = 1
+
+header = struct.Struct('<4sBBHId')
+times_header = struct.Struct('<4sBI')
+
+
+def write_varint(out, n):
+    while 127 < n:
+        out.append(n & 127 | 128)
+        n >>= 7
+
+    out.append(n)
+
+
+# Toolpaths repeat the same deltas so encoded varints are cached
+@functools.lru_cache(maxsize = 4096)
+def varint(n):
+    out = bytearray()
+    write_varint(out, n)
+    return bytes(out)
+
+
+def read_varint(data, i):
+    n = shift = 0
+
+    while True:
+        b = data[i]
+        i += 1
+        n |= (b & 127) << shift
+        if b < 128: return n, i
+        shift += 7
+
+
+class Encoder(object):
+    def __init__(self, resolution = RESOLUTION):
+        self.resolution = resolution
+        self.scale = 1 / resolution
+        self.last = (0, 0, 0)
+        self.positions = bytearray()
+        self.runs = []
+        self.vertices = 0
+
+
+    # ``positions`` holds x, y and z per vertex and ``speeds`` is an
+    # array('f') with one speed per vertex
+    def add_block(self, positions, speeds):
+        scale = self.scale
+        q = [round(v * scale) for v in positions]
+        deltas = map(operator.sub, q, list(self.last) + q[:-3])
+        zigzag = [d << 1 if 0 <= d else (-d << 1) - 1 for d in deltas]
+
+        if max(zigzag) < 128: self.positions += bytes(zigzag)
+        else: self.positions += b''.join(map(varint, zigzag))
+
+        self.last = q[-3:]
+        self.vertices += len(speeds)
+
+        # Group runs on the float32 bits so NaN rapids compare equal
+        runs = self.runs
+        for bits, group in itertools.groupby(array('I', speeds.tobytes())):
+            count = sum(1 for _ in group)
+            if runs and runs[-1][1] == bits: runs[-1][0] += count
+            else: runs.append([count, bits])
+
+
+    def encode(self):
+        out = bytearray(header.pack(MAGIC, VERSION, 0, 0, self.vertices,
+                                    self.resolution))
+        out += self.positions
+        write_varint(out, len(self.runs))
+
+        for count, bits in self.runs:
+            write_varint(out, count)
+            out += struct.pack('=I', bits)
+
+        return bytes(out)
+
+
+# Returns positions and speeds as packed float32 arrays
+def decode(data):
+    magic, version, flags, _, vertices, resolution = header.unpack_from(data)
+    if magic != MAGIC: raise ValueError('Not a toolpath file')
+    if version != VERSION:
+        raise ValueError('Unsupported toolpath version %d' % version)
+
+    i = header.size
+    q = [0, 0, 0]
+    positions = array('f')
+
+    for v in range(vertices):
+        for axis in range(3):
+            n, i = read_varint(data, i)
+            q[axis] += -(n + 1 >> 1) if n & 1 else n >> 1
+            positions.append(q[axis] * resolution)
+
+    runs, i = read_varint(data, i)
+    speeds = bytearray()
+
+    for run in range(runs):
+        count, i = read_varint(data, i)
+        speeds += data[i:i + 4] * count
+        i += 4
+
+    return positions.tobytes(), bytes(speeds)
+
+
+def encode_times(lines, times):
+    return (times_header.pack(TIMES_MAGIC, TIMES_VERSION, len(lines)) +
+            array('I', lines).tobytes() + array('f', times).tobytes())
+
+
+# Returns ascending line numbers and the planned time at each
+def decode_times(data):
+    magic, version, count = times_header.unpack_from(data)
+    if magic != TIMES_MAGIC or version != TIMES_VERSION:
+        raise ValueError('Unsupported line times file')
+
+    i = times_header.size
+    lines = array('I', data[i:i + 4 * count])
+    times = array('f', data[i + 4 * count:i + 8 * count])
+
+    return lines, times
+
+
+def compress(data):
+    if zstandard is not None:
+        return zstandard.ZstdCompressor(level = 10).compress(data)
+
+    return gzip.compress(data)
+
+
+def get_encoding(data):
+    return 'zstd' if data[:4] == ZSTD_MAGIC else 'gzip'
+
+
+def decompress(data):
+    if get_encoding(data) == 'zstd':
+        return zstandard.ZstdDecompressor().decompress(data)
+
+    return gzip.decompress(data)
+
+
+def save(path, data):
+    with open(path, 'wb') as f: f.write(compress(data))
@@ -0,0 +1,196 @@
+################################################################################
+#                                                                              #
+#                This file is part of the Buildbotics firmware.                #
+#                                                                              #
+#                  Copyright (c) 2015 - 2018, Buildbotics LLC                  #
+#                             All rights reserved.                             #
+#                                                                              #
+#     This file ("the software") is free software: you can redistribute it     #
+#     and/or modify it under the terms of the GNU General Public License,      #
+#      version 2 as published by the Free Software Foundation. You should      #
+#      have received a copy of the GNU General Public License, version 2       #
+#     along with the software. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                              #
+#     The software is distributed in the hope that it will be useful, but      #
+#          WITHOUT ANY WARRANTY; without even the implied warranty of          #
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU       #
+#               Lesser General Public License for more details.                #
+#                                                                              #
+#       You should have received a copy of the GNU Lesser General Public       #
+#                License along with the software.  If not, see                 #
+#                       <http://www.gnu.org/licenses/>.                        #
+#                                                                              #
+#                For information regarding this software email:                #
+#                  "Joseph Coffland" <joseph@buildbotics.com>                  #
+#                                                                              #
+################################################################################
+
+import os
+import re
+import json
+import time
+
+
+reCacheFile = re.compile(r'^(?P<hid>[0-9a-f]{64})\.')
+
+
+def safe_remove(path):
+    try:
+        os.unlink(path)
+    except OSError: pass
+
+
+# Content-addressed store of plan results keyed by plan hash.  Entries are
+# evicted least recently used first once the total size exceeds the disk
+# budget.  An index file records entry sizes and access times so the
+# directory does not have to be scanned on startup.
+class PlanCache(object):
+    lods = 3 # Level-of-detail geometry written by plan.py, coarsest last
+    exts = ('meta.json', 'path.bin', 'times.bin', 'checkpoints.bin') + tuple(
+        'path.%d.bin' % lod for lod in range(1, lods + 1))
+
+
+    def __init__(self, ctrl, max_size):
+        self.ctrl = ctrl
+        self.log = ctrl.log.get('Preplanner')
+        self.max_size = max_size
+        self.dir = ctrl.get_plan()
+        self.index_path = ctrl.get_plan('index.json')
+        self.save_timeout = None
+
+        if not os.path.exists(self.dir): os.mkdir(self.dir)
+
+        self.entries = self._load_index()
+        if self.entries is None: self.entries = self._rebuild_index()
+
+
+    def _load_index(self):
+        try:
+            if os.path.exists(self.index_path):
+                with open(self.index_path, 'r') as f: index = json.load(f)
+
+                # Rebuild if the set of plan files has changed
+                if index.get('exts') == list(self.exts):
+                    return index['entries']
+
+        except Exception as e:
+            self.log.warning('Failed to load plan cache index: %s', e)
+
+
+    def _rebuild_index(self):
+        self.log.info('Rebuilding plan cache index')
+        entries = {}
+        files = {}
+
+        for name in os.listdir(self.dir):
+            path = os.path.join(self.dir, name)
+            if name == os.path.basename(self.index_path): continue
+
+            m = reCacheFile.match(name)
+            if m is None:
+                safe_remove(path) # Obsolete per-filename plan
+                continue
+
+            hid = m.group('hid')
+            e = entries.setdefault(hid, dict(size = 0, atime = 0))
+            e['size'] += os.path.getsize(path)
+            e['atime'] = max(e['atime'], os.path.getmtime(path))
+            files.setdefault(hid, []).append(path)
+
+        # Drop incomplete entries and those in an old format
+        for hid in list(entries):
+            if sorted(files[hid]) != sorted(self.paths(hid)):
+                for path in files[hid]: safe_remove(path)
+                del entries[hid]
+
+        self.entries = entries
+        self._save()
+
+        return entries
+
+
+    def _save(self):
+        if self.save_timeout is not None:
+            self.ctrl.ioloop.remove_timeout(self.save_timeout)
+            self.save_timeout = None
+
+        tmp = self.index_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(dict(exts = self.exts, entries = self.entries), f)
+        os.rename(tmp, self.index_path)
+
+
+    def _save_later(self):
+        if self.save_timeout is None:
+            self.save_timeout = self.ctrl.ioloop.call_later(5, self._save)
+
+
+    def get_size(self): return sum(e['size'] for e in self.entries.values())
+
+
+    def path(self, hid, ext):
+        return os.path.join(self.dir, '%s.%s' % (hid, ext))
+
+
+    def paths(self, hid): return [self.path(hid, ext) for ext in self.exts]
+
+
+    def has(self, hid): return hid in self.entries
+    def is_full(self): return self.max_size <= self.get_size()
+
+
+    def touch(self, hid):
+        if hid in self.entries:
+            self.entries[hid]['atime'] = time.time()
+            self._save_later()
+
+
+    def add(self, hid, src, evict = True):
+        # Move finished plan files from directory src into the cache.  Without
+        # evict the plan is only added if it fits.  Returns True if added.
+        size = sum(os.path.getsize(os.path.join(src, ext)) for ext in self.exts)
+        if not evict and self.max_size < self.get_size() + size: return False
+
+        for ext, path in zip(self.exts, self.paths(hid)):
+            os.rename(os.path.join(src, ext), path)
+
+        self.entries[hid] = dict(size = size, atime = time.time())
+        self._evict(hid)
+        self._save()
+
+        return True
+
+
+    def remove(self, hid):
+        for path in self.paths(hid): safe_remove(path)
+
+        if hid in self.entries:
+            del self.entries[hid]
+            self._save_later()
+
+
+    def clear(self):
+        for hid in list(self.entries):
+            for path in self.paths(hid): safe_remove(path)
+
+        self.entries = {}
+        self._save()
+
+
+    def _evict(self, keep = None):
+        total = self.get_size()
+        if total <= self.max_size: return
+
+        lru = sorted(self.entries.items(), key = lambda e: e[1]['atime'])
+
+        for hid, e in lru:
+            if total <= self.max_size: break
+            if hid == keep: continue
+
+            self.log.info('Evicting plan %s', hid)
+            total -= e['size']
+            self.remove(hid)
+
+
+    def close(self):
+        if self.save_timeout is not None: self._save()
@@ -0,0 +1,195 @@
+################################################################################
+#                                                                              #
+#                This file is part of the Buildbotics firmware.                #
+#                                                                              #
+#                  Copyright (c) 2015 - 2018, Buildbotics LLC                  #
+#                             All rights reserved.                             #
+#                                                                              #
+#     This file ("the software") is free software: you can redistribute it     #
+#     and/or modify it under the terms of the GNU General Public License,      #
+#      version 2 as published by the Free Software Foundation. You should      #
+#      have received a copy of the GNU General Public License, version 2       #
+#     along with the software. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                              #
+#     The software is distributed in the hope that it will be useful, but      #
+#          WITHOUT ANY WARRANTY; without even the implied warranty of          #
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU       #
+#               Lesser General Public License for more details.                #
+#                                                                              #
+#       You should have received a copy of the GNU Lesser General Public       #
+#                License along with the software.  If not, see                 #
+#                       <http://www.gnu.org/licenses/>.                        #
+#                                                                              #
+#                For information regarding this software email:                #
+#                  "Joseph Coffland" <joseph@buildbotics.com>                  #
+#                                                                              #
+################################################################################
+
+import os
+import json
+import signal
+from tornado import gen, process, iostream
+import bbctrl
+
+
+class PlanWorker(object):
+    def __init__(self, pool):
+        self.pool = pool
+        self.log = pool.log
+        self.proc = None
+        self.ready = None
+        self.busy = False
+        self.cancelled = False
+        self.kill_timeout = None
+
+
+    def start(self):
+        # Restart if not yet started, killed or failed to start
+        if (self.ready is None or
+            (self.ready.done() and self.ready.exception() is not None)):
+            self.ready = self._start()
+
+        return self.ready
+
+
+    @gen.coroutine
+    def _start(self):
+        cmd = ('/usr/bin/env', 'python3', bbctrl.get_resource('plan.py'),
+               '--worker')
+
+        self.log.info('Starting planner worker: %s', cmd)
+
+        self.proc = process.Subprocess(cmd, stdin = process.Subprocess.STREAM,
+                                       stdout = process.Subprocess.STREAM)
+
+        try:
+            msg = yield self._read_msg()
+            if not msg.get('ready', False): raise Exception('Not ready')
+
+        except Exception as e:
+            self.kill()
+            raise Exception('Planner worker failed to start: %s' % e)
+
+
+    @gen.coroutine
+    def _read_msg(self):
+        line = yield self.proc.stdout.read_until(b'\n')
+        return json.loads(line.decode('utf8'))
+
+
+    def _set_kill_timeout(self, delay):
+        self._clear_kill_timeout()
+        self.kill_timeout = self.pool.ioloop.call_later(delay, self._hung)
+
+
+    def _clear_kill_timeout(self):
+        if self.kill_timeout is not None:
+            self.pool.ioloop.remove_timeout(self.kill_timeout)
+            self.kill_timeout = None
+
+
+    def _hung(self):
+        self.kill_timeout = None
+        self.log.warning('Planner worker %d not responding, killing it' %
+                         self.proc.pid)
+        self.kill()
+
+
+    def kill(self):
+        self._clear_kill_timeout()
+        if self.proc is None: return
+
+        try:
+            os.kill(self.proc.pid, signal.SIGKILL)
+        except OSError: pass
+
+        self.proc.stdin.close()
+        self.proc.stdout.close()
+        self.proc.proc.wait()
+        self.proc = None
+        self.ready = None
+
+
+    def cancel(self):
+        if self.cancelled: return
+        self.cancelled = True
+
+        # Still starting, run() checks before sending the job
+        if not self.busy: return
+
+        try:
+            os.kill(self.proc.pid, signal.SIGUSR1)
+        except OSError: pass
+
+        # Fall back to killing the process if it does not abort in time
+        self._set_kill_timeout(self.pool.cancel_timeout)
+
+
+    @gen.coroutine
+    def run(self, job, progress_cb):
+        # Returns True if the job finished, False if it was cancelled
+        yield self.start()
+        if self.cancelled: return False
+
+        self.busy = True
+        self._set_kill_timeout(job['max_time'] + self.pool.cancel_timeout)
+
+        try:
+            data = json.dumps(job, separators = (',', ':')) + '\n'
+            yield self.proc.stdin.write(data.encode('utf8'))
+
+            while True:
+                msg = yield self._read_msg()
+
+                if 'progress' in msg: progress_cb(msg)
+                elif 'error' in msg: raise Exception(msg['error'])
+                else: return msg.get('done', False) and not self.cancelled
+
+        except iostream.StreamClosedError:
+            self.kill()
+            if self.cancelled: return False
+            raise Exception('Planner worker exited unexpectedly')
+
+        finally:
+            self._clear_kill_timeout()
+            self.busy = False
+
+
+class PlanWorkerPool(object):
+    def __init__(self, ctrl, size = 1, cancel_timeout = 5):
+        self.ioloop = ctrl.ioloop
+        self.log = ctrl.log.get('Preplanner')
+        self.size = size
+        self.cancel_timeout = cancel_timeout
+
+        self.workers = [PlanWorker(self) for i in range(size)]
+        self.idle = list(self.workers)
+
+
+    def start(self): self.ioloop.add_callback(self._start)
+
+
+    @gen.coroutine
+    def _start(self):
+        # Pay interpreter startup and imports before the first plan
+        for worker in self.workers:
+            try:
+                yield worker.start()
+            except Exception:
+                self.log.exception('Failed to start planner worker')
+
+
+    def has_idle(self): return bool(len(self.idle))
+
+
+    def acquire(self):
+        worker = self.idle.pop()
+        worker.cancelled = False # Not cancelled for its previous holder
+        return worker
+
+
+    def release(self, worker): self.idle.append(worker)
+
+
+    def close(self):
+        for worker in self.workers: worker.kill()
@@ -29,12 +29,27 @@ import json
 import math
 import re
 import time
+import bisect
+import shutil
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from tornado import gen
 import camotics.gplan as gplan # pylint: disable=no-name-in-module,import-error
 import bbctrl.Cmd as Cmd
 from bbctrl.CommandQueue import CommandQueue
 
 
+# Commands encoded ahead of the serial port and encoded per ioloop callback
+LOOKAHEAD = 32
+FILL_BATCH = 8
+
+# Seconds to let the spindle reach speed before plunging on resume
+SPIN_UP = 3
+
+# Plunge feed in mm/min when resuming a program without a known plunge feed
+PLUNGE_FEED = 100
+
+
 reLogLine = re.compile(
     r'^(?P<level>[A-Z])[0-9 ]:'
     r'((?P<file>[^:]+):)?'
@@ -53,6 +68,69 @@ def log_floats(o):
 def log_json(o): return json.dumps(log_floats(o))
 
 
+def resume_gcode(cp, metric, max_z_vel = None):
+    # GCode which restores a checkpoint's machine state
+    modal = cp['modal']
+    if 'motion' not in modal:
+        raise Exception('Cannot resume at line %d, unknown motion mode' %
+                        cp['line'])
+
+    pos = cp['position']
+    units = modal.get('units', 'G21' if metric else 'G20')
+    gcode = ['(Resume from line %d)' % cp['line'], 'G21 G90']
+
+    # Clear the work then move over the resume point in machine coordinates
+    if 'z' in pos:
+        gcode.append('G53 G0 Z%.4f' % max(pos['z'], cp['safe_z']))
+
+    xy = ' '.join('%s%.4f' % (axis.upper(), pos[axis])
+                 for axis in 'xy' if axis in pos)
+    if xy: gcode.append('G53 G0 ' + xy)
+
+    for group in ('coords', 'plane'):
+        if group in modal: gcode.append(modal[group])
+
+    if cp['tool'] is not None: gcode.append('T%d' % cp['tool'])
+    if cp['speed'] is not None: gcode.append('S%g' % cp['speed'])
+    if cp['spindle'] in ('M3', 'M4'): gcode.append(cp['spindle'])
+    if cp['mist']: gcode.append('M7')
+    if cp['flood']: gcode.append('M8')
+
+    # Let the spindle reach speed
+    if cp['spindle'] in ('M3', 'M4'): gcode.append('G4 P%g' % SPIN_UP)
+
+    # Plunge at the program's last plunge feed rate, limited by the Z axis
+    if 'z' in pos:
+        feed = cp.get('plunge_feed')
+        if feed is None: feed = PLUNGE_FEED
+        elif (cp.get('plunge_units') or units) == 'G20': feed *= 25.4
+        if max_z_vel: feed = min(feed, max_z_vel)
+        gcode.append('G53 G1 Z%.4f F%g' % (pos['z'], feed))
+
+    gcode.append(units + ' ' + modal.get('distance', 'G90'))
+    if 'feed_mode' in modal: gcode.append(modal['feed_mode'])
+    if cp['feed'] is not None: gcode.append('F%g' % cp['feed'])
+
+    # Restore the motion mode last so the program continues in it
+    gcode.append(modal['motion'])
+
+    return ''.join(line + '\n' for line in gcode)
+
+
+def write_resume(path, resume, gcode, cp):
+    # Copies the program from the checkpoint's line after the resume GCode
+    with open(path, 'rb') as src, open(resume, 'wb') as dst:
+        dst.write(gcode.encode('utf8'))
+
+        if 'offset' in cp: src.seek(cp['offset'])
+        else:
+            # Checkpoints from before byte offsets were recorded
+            for i in range(cp['line'] - 1):
+                if not src.readline(): break
+
+        shutil.copyfileobj(src, dst)
+
+
 class Planner():
     def __init__(self, ctrl):
         self.ctrl = ctrl
@@ -61,18 +139,30 @@ class Planner():
         self.planner = None
         self._position_dirty = False
         self.where = ''
+        self.executor = ThreadPoolExecutor(1) # Resume file copies
+
+        # Encoded commands waiting for the serial port
+        self.lookahead = deque()
+        self.fill_scheduled = False
+        self.primed = False
+        self.failed = False
+        self.underruns = 0
 
         ctrl.state.add_listener(self._update)
 
         self.reset(stop = False)
         self._report_time()
+        self._report_lookahead()
 
 
     def is_busy(self): return self.is_running() or self.cmdq.is_active()
-    def is_running(self): return self.planner.is_running()
     def position_change(self): self._position_dirty = True
 
 
+    def is_running(self):
+        return self.planner.is_running() or bool(self.lookahead)
+
+
     def _sync_position(self, force = False):
         if not force and not self._position_dirty: return
         self._position_dirty = False
@@ -195,10 +285,27 @@ class Planner():
         self.cmdq.enqueue(id, self.ctrl.state.set, name, value)
 
 
+    def _lookup_time(self, line):
+        # Interpolate the preplanned time at the start of a line
+        lines, times = self.line_times
+        i = bisect.bisect_right(lines, line)
+
+        if not i: return 0
+        if i == len(lines): return times[-1]
+
+        l0, l1 = lines[i - 1], lines[i]
+        t0, t1 = times[i - 1], times[i]
+        return t0 + (t1 - t0) * (line - l0) / (l1 - l0)
+
+
     def _report_time(self):
         state = self.ctrl.state.get('xx', '')
 
-        if state in ('STOPPING', 'RUNNING') and self.move_start:
+        if state in ('STOPPING', 'RUNNING') and self.line_times is not None:
+            line = self.ctrl.state.get('line', 0)
+            self.ctrl.state.set('plan_time', round(self._lookup_time(line)))
+
+        elif state in ('STOPPING', 'RUNNING') and self.move_start:
             delta = time.time() - self.move_start
             if self.move_time < delta: delta = self.move_time
             plan_time = self.current_plan_time + delta
@@ -210,6 +317,12 @@ class Planner():
         self.ctrl.ioloop.call_later(1, self._report_time)
 
 
+    def _report_lookahead(self):
+        self.ctrl.state.set('lookahead', len(self.lookahead))
+        self.ctrl.state.set('lookahead_underruns', self.underruns)
+        self.ctrl.ioloop.call_later(1, self._report_lookahead)
+
+
     def _plan_time_restart(self):
         self.plan_time = self.ctrl.state.get('plan_time', 0)
 
@@ -241,7 +354,10 @@ class Planner():
     def __encode(self, block):
         type, id = block['type'], block['id']
 
-        if type != 'set': self.log.info('Cmd:' + log_json(block))
+        if type != 'set':
+            self.ctrl.trace.add('Cmd', block)
+            if self.ctrl.args.log_commands:
+                self.log.info('Cmd:' + log_json(block))
 
         if type == 'line':
             self._enqueue_line_time(block)
@@ -255,6 +371,9 @@ class Planner():
             if name == 'message':
                 self.cmdq.enqueue(id, self._add_message, value)
 
+            if name == 'line' and self.resume_line:
+                value = max(self.resume_line, value + self.line_offset)
+
             if name in ['line', 'tool']: self._enqueue_set_cmd(id, name, value)
 
             if name == 'speed':
@@ -315,6 +434,9 @@ class Planner():
         self.move_time = 0
         self.plan_time = 0
         self.current_plan_time = 0
+        self.line_times = None
+        self.resume_line = 0
+        self.line_offset = 0
 
 
     def close(self):
@@ -323,12 +445,21 @@ class Planner():
             self.planner.set_resolver(None)
             self.planner.set_logger(None)
 
+        self.executor.shutdown(wait = False)
+
+
+    def _flush_lookahead(self):
+        self.lookahead.clear()
+        self.primed = False
+        self.failed = False
+
 
     def reset(self, *args, **kwargs):
         stop = kwargs.get('stop', True)
         if stop:
             self.ctrl.mach.stop()
 
+        self._flush_lookahead()
         self.planner = gplan.Planner()
         self.planner.set_resolver(self._get_var_cb)
         # TODO logger is global and will not work correctly in demo mode
@@ -350,16 +481,48 @@ class Planner():
         self.reset_times()
 
 
-    def load(self, path):
+    @gen.coroutine
+    def write_resume(self, filename, cp):
+        # Writes the program to resume from a checkpoint in a thread, large
+        # programs take seconds to copy
+        path = self.ctrl.get_path('upload', filename)
+        state = self.ctrl.state
+        gcode = resume_gcode(cp, state.get('metric', True),
+                             state.get_axis_vector('vm', 1000).get('z'))
+        resume = self.ctrl.get_path('resume.nc')
+
+        yield self.executor.submit(write_resume, path, resume, gcode, cp)
+
+        return resume, gcode.count('\n')
+
+
+    def load(self, path, checkpoint = None, resume = None):
+        # resume is the file from write_resume() when starting at checkpoint
         self.where = path
         path = self.ctrl.get_path('upload', path)
         self.log.info('GCode:' + path)
         self._sync_position()
+
+        if checkpoint is not None:
+            self.log.info('Resuming from line %d' % checkpoint['line'])
+            path, count = resume
+
         self.planner.load(path, self.get_config(False, True))
         self.reset_times()
+        self.underruns = 0
+
+        if checkpoint is not None:
+            # Report line numbers of the original program
+            self.resume_line = checkpoint['line']
+            self.line_offset = checkpoint['line'] - 1 - count
+
+        # Progress is a lookup on the current line if the file was preplanned
+        self.line_times = self.ctrl.preplanner.get_plan_times(self.where)
 
 
     def stop(self):
+        self._flush_lookahead()
+
         try:
             self.planner.stop()
             self.cmdq.clear()
@@ -376,6 +539,7 @@ class Planner():
 
             self.log.info('Planner restart: %d %s' % (id, log_json(position)))
 
+            self._flush_lookahead()
             self.cmdq.clear()
             self.cmdq.release(id)
             self._plan_time_restart()
@@ -386,18 +550,51 @@ class Planner():
             self.stop()
 
 
-    def next(self):
+    def _fill(self, count = FILL_BATCH, underrun = False):
+        # Encode up to count more commands ahead of the serial port.  On error
+        # the commands already encoded are still sent before stopping.
+        self.fill_scheduled = False
+        if self.failed: return
+        target = min(len(self.lookahead) + count, LOOKAHEAD)
+
         try:
-            while self.planner.has_more():
-                cmd = self.planner.next()
-                cmd = self._encode(cmd)
-                if cmd is not None: return cmd
+            while len(self.lookahead) < target and self.planner.has_more():
+                cmd = self._encode(self.planner.next())
+                if cmd is not None: self.lookahead.append(cmd)
 
         except RuntimeError as e:
             # Pass on the planner message
             self.log.error(str(e))
-            self.stop()
+            self.ctrl.trace.dump('planner error')
+            self.failed = True
 
         except:
             self.log.exception('Internal error: Planner next')
-            self.stop()
+            self.ctrl.trace.dump('planner error')
+            self.failed = True
+
+        if self.lookahead:
+            if underrun: self.underruns += 1
+            self.primed = True
+
+        # The planner may have more
+        if len(self.lookahead) == target and not self.failed:
+            self._schedule_fill()
+
+
+    def _schedule_fill(self):
+        if not self.fill_scheduled and len(self.lookahead) < LOOKAHEAD:
+            self.fill_scheduled = True
+            self.ctrl.ioloop.add_callback(self._fill)
+
+
+    def next(self):
+        # Commands the lookahead did not have ready are encoded now
+        if not self.lookahead: self._fill(1, self.primed)
+
+        if self.lookahead:
+            cmd = self.lookahead.popleft()
+            self._schedule_fill()
+            return cmd
+
+        if self.failed: self.stop()
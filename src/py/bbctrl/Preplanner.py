@@ -26,15 +26,23 @@
 ################################################################################
 
 import os
+import math
 import time
 import json
+import shutil
 import hashlib
-import glob
 import tempfile
-import signal
-from concurrent.futures import Future
-from tornado import gen, process, iostream
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from tornado import gen
 import bbctrl
+import bbctrl.PathFormat as PathFormat
+import bbctrl.GCodeScan as GCodeScan
+from bbctrl.Planner import resume_gcode
+
+
+# Most vertices returned by one partial geometry request
+MAX_PARTIAL = 64 * 1024
 
 
 def hash_dump(o):
@@ -42,189 +50,597 @@ def hash_dump(o):
     return s.encode('utf8')
 
 
-def plan_hash(path, config):
+def plan_hash(content_hash, config, limits):
     h = hashlib.sha256()
-    h.update('v4'.encode('utf8'))
+    h.update('v11'.encode('utf8'))
     h.update(hash_dump(config))
+    h.update(hash_dump(limits))
+    h.update(content_hash.encode('utf8'))
+    return h.hexdigest()
+
+
+# Motor state variables the plan config and limits are made from
+plan_vars = ('vm', 'am', 'jm', 'tn', 'tm', 'an', 'me')
+
+
+def get_plan_config(ctrl):
+    config = ctrl.mach.planner.get_config(False, False)
+    del config['default-units']
+    return config
+
+
+def get_plan_limits(ctrl):
+    # Configured soft limits whether or not the axes are homed yet
+    state = ctrl.state
+    minLimit = state.get_axis_vector('tn')
+    maxLimit = state.get_axis_vector('tm')
+    limits = dict(min = {}, max = {})
+
+    for axis in 'xyz':
+        if axis in minLimit and axis in maxLimit and \
+                minLimit[axis] < maxLimit[axis]:
+            limits['min'][axis] = minLimit[axis]
+            limits['max'][axis] = maxLimit[axis]
+
+    return limits
+
+
+def get_scan_args(state, config):
+    # Settings the quick GCode scan depends on
+    offsets = {axis: state.get('offset_' + axis, 0) for axis in 'xyz'}
+    return offsets, config['max-vel'], state.get('metric', True)
+
+
+def match_prefix(path, checkpoints):
+    # Returns the last checkpoint whose preceding text is unchanged in path
+    match = None
+    offset = 0
 
     with open(path, 'rb') as f:
-        while True:
-            buf = f.read(1024 * 1024)
-            if not buf: break
-            h.update(buf)
+        for cp in checkpoints:
+            if 'hash' not in cp: break
+            h = hashlib.sha256()
 
-    return h.hexdigest()
+            while offset < cp['offset']:
+                data = f.read(min(cp['offset'] - offset, 1024 * 1024))
+                if not data: break
+                h.update(data)
+                offset += len(data)
+
+            if offset != cp['offset'] or h.hexdigest() != cp['hash']: break
+            match = cp
 
+    return match
 
-def safe_remove(path):
+
+def read_range(path, offset, size):
     try:
-        os.unlink(path)
-    except: pass
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            return f.read(size)
+
+    except FileNotFoundError: pass
+
+
+def prepare_resume(gcode, files, offsets, metric, max_z_vel, tmpdir):
+    # Sets up planning the changed part of gcode on top of an earlier plan
+    # of the same file, returns None if nothing can be reused
+    with open(files['checkpoints.bin'], 'rb') as f:
+        data = json.loads(PathFormat.decompress(f.read()).decode('utf8'))
+
+    if data['offsets'] != offsets: return
+    cp = match_prefix(gcode, data['checkpoints'])
+    if cp is None or 'motion' not in cp['modal']: return
+
+    # Copy the base plan in case it is evicted while planning
+    dir = os.path.join(tmpdir, 'base')
+    os.mkdir(dir)
+    for ext, path in files.items(): shutil.copy(path, os.path.join(dir, ext))
+
+    preamble = resume_gcode(cp, metric, max_z_vel)
+    path = os.path.join(tmpdir, 'resume.nc')
+
+    with open(path, 'wb') as out, open(gcode, 'rb') as f:
+        out.write(preamble.encode('utf8'))
+        f.seek(cp['offset'])
+        shutil.copyfileobj(f, out)
+
+    return dict(dir = dir, gcode = path, line = cp['line'],
+                preamble = preamble.count('\n'))
 
 
 class Plan(object):
-    def __init__(self, preplanner, ctrl, filename):
+    def __init__(self, preplanner, ctrl, filename, priority = 0):
         self.preplanner = preplanner
+        self.filename = filename
+        self.priority = priority # 0 = background, 1 = requested
 
-        # Copy planner state
-        self.state = ctrl.state.snapshot()
-        self.config = ctrl.mach.planner.get_config(False, False)
-        del self.config['default-units']
+        # Copy planner settings, the state is copied when a worker is free
+        self.state = None
+        self.config = get_plan_config(ctrl)
+        self.limits = get_plan_limits(ctrl)
 
         self.progress = 0
+        self.vertices = 0
+        self.tmpdir = None
         self.cancel = False
-        self.pid = None
-
-        root = ctrl.get_path()
-        self.gcode = '%s/upload/%s' % (root, filename)
-        self.base = '%s/plans/%s' % (root, filename)
-        self.hid = plan_hash(self.gcode, self.config)
-        fbase = '%s.%s.' % (self.base, self.hid)
-        self.files = [
-            fbase + 'json',
-            fbase + 'positions.gz',
-            fbase + 'speeds.gz']
+        self.preempted = False
+        self.ready = False
+        self.worker = None
+        self.waiting = None
+        self.start_time = None
+        self.estimate = None
+        self.missed = False # Not found in the plan cache
+        self.base = None # An earlier plan of this file which may be reused
+
+        self.gcode = ctrl.get_upload(filename)
+
+        # Use the estimate made while the file was uploaded if still valid
+        upload = preplanner.uploads.pop(filename, None)
+        if upload is not None and \
+                upload.scan_args == get_scan_args(ctrl.state, self.config):
+            self.estimate = upload.estimate
+
+        try:
+            self.size = os.path.getsize(self.gcode)
+        except OSError: self.size = 0
 
         self.future = Future()
         ctrl.ioloop.add_callback(self._load)
 
 
+    def request(self):
+        self._estimate()
+
+        if not self.priority:
+            self.priority = 1
+
+            if self.ready and not self.preplanner.cache.has(self.hid):
+                # Evicted before it was requested, plan it again
+                self.ready = False
+                self.progress = 0
+                self.preplanner.ctrl.ioloop.add_callback(self._load)
+
+            elif self.ready: self.future.set_result(self._read())
+            else: self.preplanner._schedule()
+
+        return self.future
+
+
+    def _estimate(self):
+        # Only worth scanning while the file is being planned
+        if self.estimate is not None or self.ready or not self.missed: return
+
+        state = self.preplanner.ctrl.state
+        self.estimate = self.preplanner.executor.submit(
+            GCodeScan.scan, self.gcode, *get_scan_args(state, self.config))
+
+
+    def get_estimate(self):
+        # Provisional metadata from a quick scan of the GCode
+        self._estimate()
+        estimate = self.estimate
+
+        if estimate is not None and estimate.done():
+            if estimate.exception() is None: return estimate.result()
+
+
+    def remaining(self, rate):
+        # Estimated seconds until this plan is finished
+        if self.ready: return 0
+
+        if self.start_time is not None and self.progress:
+            elapsed = time.time() - self.start_time
+            return elapsed * (1 - self.progress) / self.progress
+
+        if rate: return self.size / rate
+
+
     def terminate(self):
         if self.cancel: return
         self.cancel = True
-        if self.pid is not None:
-            try:
-                os.kill(self.pid, signal.SIGKILL)
-            except: pass
+        if self.worker is not None: self.worker.cancel()
+        if self.estimate is not None: self.estimate.cancel() # If not started
 
+        # Wake _exec() if still waiting for a worker
+        if self.waiting is not None and not self.waiting.done():
+            self.preplanner._dequeue(self)
+            self.waiting.set_result(None)
 
-    def delete(self):
-        files = glob.glob(self.base + '.*')
-        for path in files: safe_remove(path)
 
+    def preempt(self):
+        if self.worker is None or self.preempted: return
+        self.preplanner.log.info('Preempting plan: %s', self.filename)
+        self.preempted = True
+        self.worker.cancel()
 
-    def clean(self, max = 2):
-        plans = glob.glob(self.base + '.*.json')
-        if len(plans) <= max: return
 
-        # Delete oldest plans
-        plans = [(os.path.getmtime(path), path) for path in plans]
-        plans.sort()
+    @gen.coroutine
+    def _hash(self):
+        fp = yield self.preplanner.fingerprints.get(self.gcode)
+        self.lines = fp['lines']
+        self.hid = plan_hash(fp['hash'], self.config, self.limits)
+        self.files = self.preplanner.cache.paths(self.hid)
 
-        for mtime, path in plans[:len(plans) - max]:
-            safe_remove(path)
-            safe_remove(path[:-4] + 'positions.gz')
-            safe_remove(path[:-4] + 'speeds.gz')
+        # Only plans with the same settings have reusable geometry
+        last = self.preplanner.last_plans.get(self.filename)
+        if last is not None and last[0] != self.hid and \
+                last[1:] == (self.config, self.limits):
+            self.base = last[0]
 
 
-    def _exists(self):
-        for path in self.files:
-            if not os.path.exists(path): return False
-        return True
+    @gen.coroutine
+    def _prepare_base(self, tmpdir):
+        # Returns the job settings to replan only the changed end of the file
+        cache = self.preplanner.cache
+        if self.base is None or not cache.has(self.base): return
+
+        files = dict(zip(cache.exts, cache.paths(self.base)))
+        offsets = {axis: self.state.get('offset_' + axis, 0) for axis in 'xyz'}
+        metric = self.state.get('metric', True)
+        max_z_vel = self.config['max-vel'].get('z')
+
+        try:
+            base = yield self.preplanner.executor.submit(
+                prepare_resume, self.gcode, files, offsets, metric, max_z_vel,
+                tmpdir)
+
+            if base is not None:
+                self.preplanner.log.info('Replanning %s from line %d',
+                                         self.filename, base['line'])
+
+            return base
+
+        except Exception as e:
+            self.preplanner.log.warning('Cannot reuse plan of %s: %s',
+                                        self.filename, e)
+
+
+    def _finished(self):
+        self.progress = 1
+        self.ready = True
+
+        if self._exists():
+            self.preplanner.last_plans[self.filename] = \
+                (self.hid, self.config, self.limits)
+
+
+    def _exists(self): return self.preplanner.cache.has(self.hid)
 
 
     def _read(self):
+        # Only the metadata is held in memory, geometry is served from disk
         if self.cancel: return
 
+        if not all(os.path.exists(path) for path in self.files):
+            self.preplanner.log.warning('Plan files missing: %s', self.filename)
+            self.preplanner.cache.remove(self.hid)
+            return
+
         try:
-            with open(self.files[0], 'r')  as f: meta = json.load(f)
-            with open(self.files[1], 'rb') as f: positions = f.read()
-            with open(self.files[2], 'rb') as f: speeds = f.read()
+            with open(self.files[0], 'r') as f: meta = json.load(f)
+            self.preplanner.cache.touch(self.hid)
 
-            return meta, positions, speeds
+            return meta
 
         except:
             self.preplanner.log.exception('Internal error: Preplanner read')
+            self.preplanner.cache.remove(self.hid)
 
-            # Clean
-            for path in self.files:
-                if os.path.exists(path):
-                    os.remove(path)
+
+    def get_path(self, lod = 0):
+        ext = 'path.%d.bin' % lod if lod else 'path.bin'
+        return self.preplanner.cache.path(self.hid, ext)
+
+
+    def _on_progress(self, msg):
+        self.progress = msg['progress']
+        self.vertices = msg.get('vertices', 0)
+
+
+    @gen.coroutine
+    def read_partial(self, name, start):
+        # Returns geometry streamed by a running plan and the vertex count.
+        # Large plans are sent in pieces, the client polls for the rest.
+        if self.tmpdir is None or self.vertices <= start: return b'', start
+        size = 12 if name == 'positions' else 4
+        end = min(self.vertices, start + MAX_PARTIAL)
+        path = os.path.join(self.tmpdir, name)
+
+        data = yield self.preplanner.executor.submit(
+            read_range, path, start * size, (end - start) * size)
+
+        if data is None: return b'', start
+        return data, end
 
 
     @gen.coroutine
     def _exec(self):
-        self.clean() # Clean up old plans
-
-        with tempfile.TemporaryDirectory() as tmpdir:
-            cmd = (
-                '/usr/bin/env', 'python3',
-                bbctrl.get_resource('plan.py'),
-                os.path.abspath(self.gcode), json.dumps(self.state),
-                json.dumps(self.config),
-                '--max-time=%s' % self.preplanner.max_plan_time,
-                '--max-loop=%s' % self.preplanner.max_loop_time
-            )
-
-            self.preplanner.log.info('Running: %s', cmd)
-
-            proc = process.Subprocess(cmd, stdout = process.Subprocess.STREAM,
-                                      stderr = process.Subprocess.STREAM,
-                                      cwd = tmpdir)
-            errs = ''
-            self.pid = proc.proc.pid
+        while True:
+            worker = yield self.preplanner._acquire(self)
+            if worker is None: return # Terminated while queued
 
             try:
-                try:
-                    while True:
-                        line = yield proc.stdout.read_until(b'\n')
-                        self.progress = float(line.strip())
-                        if self.cancel: return
-                except iostream.StreamClosedError: pass
+                if self.cancel: return
+                if self._exists(): return # Same content planned while queued
+
+                # Background plans never evict, so would only be thrown away
+                if not self.priority and self.preplanner.cache.is_full():
+                    self.preplanner.log.info('Plan cache full, not planning '
+                                             '%s in the background',
+                                             self.filename)
+                    return
 
-                self.progress = 1
+                self.worker = worker
+                self.preempted = False
+                self.start_time = time.time()
+                self.state = self.preplanner.ctrl.state.snapshot()
+
+                with tempfile.TemporaryDirectory() as tmpdir:
+                    base = yield self._prepare_base(tmpdir)
+
+                    # The worker is not busy yet so cannot see these
+                    if self.cancel: return
+                    if self.preempted:
+                        self.start_time = None
+                        continue # Back in the queue
+
+                    self.tmpdir = tmpdir
+                    job = dict(
+                        gcode = os.path.abspath(self.gcode),
+                        state = self.state,
+                        config = self.config,
+                        lines = self.lines,
+                        limits = self.limits,
+                        base = base,
+                        max_time = self.preplanner.max_plan_time,
+                        max_loop = self.preplanner.max_loop_time,
+                        dir = tmpdir)
+
+                    self.preplanner.log.info('Planning: %s', self.gcode)
+
+                    done = yield worker.run(job, self._on_progress)
+                    self.tmpdir = None
+
+                    if self.preempted and not self.cancel:
+                        # Back in the queue, start over later
+                        self.progress = 0
+                        self.vertices = 0
+                        self.start_time = None
+                        continue
+
+                    self.progress = 1
+
+                    if done and not self.cancel:
+                        # Requested plans evict others, background plans
+                        # are dropped if they do not fit
+                        cache = self.preplanner.cache
+                        if cache.add(self.hid, tmpdir, bool(self.priority)):
+                            os.sync()
+
+                        else:
+                            self.preplanner.log.info(
+                                'Plan cache full, dropped plan of %s',
+                                self.filename)
+
+                        elapsed = time.time() - self.start_time
+                        self.preplanner._update_rate(self.size, elapsed)
 
-                ret = yield proc.wait_for_exit(False)
-                if ret:
-                    errs = yield proc.stderr.read_until_close()
-                    raise Exception('Plan failed: ' + errs.decode('utf8'))
+                    return
 
             finally:
-                proc.stderr.close()
-                proc.stdout.close()
-
-            if not self.cancel:
-                os.rename(tmpdir + '/meta.json',    self.files[0])
-                os.rename(tmpdir + '/positions.gz', self.files[1])
-                os.rename(tmpdir + '/speeds.gz',    self.files[2])
-                os.sync()
+                self.tmpdir = None
+                self.state = None
+                self.worker = None
+                self.preplanner._release(worker)
 
 
     @gen.coroutine
     def _load(self):
         try:
-            if self._exists():
-                data = self._read()
-                if data is not None:
-                    self.future.set_result(data)
+            yield self._hash()
+
+            if self._exists() and self.priority:
+                meta = self._read()
+                if meta is not None:
+                    self._finished()
+                    self.future.set_result(meta)
                     return
 
-            if not self._exists(): yield self._exec()
-            self.future.set_result(self._read())
+            if not self._exists():
+                self.missed = True
+                if self.priority: self._estimate()
+                yield self._exec()
+
+            self._finished()
+
+            # Background plans are only read once requested
+            if self.priority: self.future.set_result(self._read())
 
         except:
             self.preplanner.log.exception("Failed to load file - doesn't appear to be GCode.")
 
+        # Finished background plans are left in the cache only
+        if not self.priority: self.preplanner._forget(self)
+
 
 class Preplanner(object):
-    def __init__(self, ctrl, max_plan_time = 60 * 60 * 24, max_loop_time = 300):
+    def __init__(self, ctrl, max_plan_time = 60 * 60 * 24, max_loop_time = 300,
+                 max_loaded = 8):
         self.ctrl = ctrl
         self.log = ctrl.log.get('Preplanner')
 
         self.max_plan_time = max_plan_time
         self.max_loop_time = max_loop_time
+        self.max_loaded = max_loaded
 
-        path = self.ctrl.get_plan()
-        if not os.path.exists(path): os.mkdir(path)
-
+        cache_size = ctrl.args.plan_cache_size * 1024 * 1024
+        self.cache = bbctrl.PlanCache(ctrl, cache_size)
+        self.fingerprints = bbctrl.FingerprintCache(ctrl)
+        self.pool = bbctrl.PlanWorkerPool(ctrl, ctrl.args.plan_workers)
+        self.executor = ThreadPoolExecutor(1) # GCode scans and file copies
         self.started = Future()
         self.plans = {}
+        self.last_plans = {} # Hash and settings of each file's latest plan
+        self.uploads = {} # Finished uploads not yet planned
+        self.loaded = OrderedDict() # Requested plans, least recent first
+        self.queue = [] # Plans waiting for a worker
+        self.pending = deque() # Library files waiting to be preplanned
+        self.rate = None # Planning throughput in GCode bytes per second
+
+        ctrl.state.add_listener(self._update)
 
 
     def start(self):
         if not self.started.done():
             self.log.info('Preplanner started')
             self.started.set_result(True)
+            self.pool.start()
+            self._queue_files()
+
+
+    def close(self):
+        self.invalidate_all()
+        self.pool.close()
+        self.executor.shutdown(wait = False)
+        self.cache.close()
+        self.fingerprints.close()
+
+
+    def _update(self, update):
+        if 'cycle' in update:
+            if self._is_paused():
+                for plan in self._active_plans(): plan.preempt()
+
+            else: self._schedule()
+
+        if 'selected' in update: self._schedule()
+        if 'files' in update: self._queue_files()
+
+        # Motor settings saved in the config only reach the state once the
+        # AVR reports them back
+        if any(name[:1] in '0123' and name[1:] in plan_vars
+               for name in update):
+            self.update_config()
+
+
+    def _is_paused(self):
+        # Never compete with live motion
+        return self.ctrl.state.get('cycle', 'idle') == 'running'
+
+
+    def _is_urgent(self, plan):
+        return (plan.priority or
+                plan.filename == self.ctrl.state.get('selected', ''))
+
+
+    def _rank(self, plan):
+        selected = plan.filename == self.ctrl.state.get('selected', '')
+        return (not selected, -plan.priority)
+
+
+    def _sorted_queue(self): return sorted(self.queue, key = self._rank)
+
+
+    def _active_plans(self):
+        return [plan for plan in self.plans.values()
+                if plan.worker is not None]
+
+
+    def _queue_files(self):
+        if not self.started.done(): return
+
+        # Preplan the whole upload library at idle priority.  Only the names
+        # are queued, plans are made as workers become free.
+        self.pending = deque(self.ctrl.state.get('files', []))
+        self._schedule()
+
+
+    def _background_plans(self):
+        return [plan for plan in self.plans.values()
+                if not plan.priority and not plan.ready]
+
+
+    def _queue_background(self):
+        while self.pending and self.pool.has_idle() and not self.queue:
+            if self.cache.is_full(): return
+            if self.pool.size <= len(self._background_plans()): return
+
+            filename = self.pending.popleft()
+            if filename in self.plans: continue
+            if not os.path.isfile(self.ctrl.get_upload(filename)): continue
+
+            hid = self._lookup_hash(filename)
+            if hid is not None and self.cache.has(hid): continue
+
+            self.plans[filename] = Plan(self, self.ctrl, filename)
+
+
+    def _forget(self, plan):
+        if self.plans.get(plan.filename) is plan:
+            del self.plans[plan.filename]
+
+        self._schedule()
+
+
+    def _acquire(self, plan):
+        plan.waiting = Future()
+        self.queue.append(plan)
+        self._schedule()
+        return plan.waiting
+
+
+    def _dequeue(self, plan):
+        if plan in self.queue: self.queue.remove(plan)
+
+
+    def _release(self, worker):
+        self.pool.release(worker)
+        self._schedule()
+
+
+    def _preempt_for(self, plan):
+        if not self._is_urgent(plan): return
+
+        for active in self._active_plans():
+            if self._rank(plan) < self._rank(active):
+                active.preempt()
+                return
+
+
+    def _schedule(self):
+        if self._is_paused(): return
+
+        for plan in self._sorted_queue():
+            if not self.pool.has_idle():
+                self._preempt_for(plan)
+                return
+
+            self.queue.remove(plan)
+            plan.waiting.set_result(self.pool.acquire())
+
+        self._queue_background()
+
+
+    def _update_rate(self, size, elapsed):
+        if not size or elapsed <= 0: return
+        rate = size / elapsed
+        if self.rate is None: self.rate = rate
+        else: self.rate = 0.7 * self.rate + 0.3 * rate
+
+
+    def _touch(self, filename):
+        self.loaded.pop(filename, None)
+        self.loaded[filename] = True
+
+        # Forget the least recently requested finished plans
+        for name in list(self.loaded):
+            if len(self.loaded) <= self.max_loaded: break
+            plan = self.plans.get(name)
+
+            if plan is None or plan.ready:
+                del self.loaded[name]
+                if plan is not None: del self.plans[name]
 
 
     def invalidate(self, filename):
@@ -232,23 +648,57 @@ class Preplanner(object):
             self.plans[filename].terminate()
             del self.plans[filename]
 
+        self.loaded.pop(filename, None)
+        self._queue_files()
+
 
     def invalidate_all(self):
         for filename, plan in self.plans.items():
             plan.terminate()
         self.plans = {}
+        self.loaded.clear()
+        self._queue_files()
+
+
+    def add_upload(self, filename, upload):
+        # The upload's fingerprint and estimate were computed as it arrived
+        path = self.ctrl.get_upload(filename)
+        if os.path.isfile(path):
+            self.fingerprints.add(path, upload.fingerprint)
+
+        self.uploads[filename] = upload
+        self.invalidate(filename)
+
+
+    def update_config(self):
+        # Only plans made with other planner settings are out of date.  Their
+        # finished results stay cached in case the settings are changed back.
+        config = get_plan_config(self.ctrl)
+        limits = get_plan_limits(self.ctrl)
+        changed = False
+
+        for filename, plan in list(self.plans.items()):
+            if plan.config == config and plan.limits == limits: continue
+            plan.terminate()
+            del self.plans[filename]
+            self.loaded.pop(filename, None)
+            changed = True
+
+        if changed:
+            self.log.info('Planner config changed')
+            self._queue_files()
 
 
     def delete_all_plans(self):
-        files = glob.glob(self.ctrl.get_plan('*'))
-        for path in files: safe_remove(path)
+        self.cache.clear()
         self.invalidate_all()
 
 
     def delete_plans(self, filename):
-        if filename in self.plans:
-            self.plans[filename].delete()
-            self.invalidate(filename)
+        # Cached plans are shared by content, leave them to LRU eviction
+        self.invalidate(filename)
+        self.last_plans.pop(filename, None)
+        self.uploads.pop(filename, None)
 
     @gen.coroutine
     def get_plan(self, filename):
@@ -259,12 +709,158 @@ class Preplanner(object):
 
         if filename in self.plans: plan = self.plans[filename]
         else:
-            plan = Plan(self, self.ctrl, filename)
+            plan = Plan(self, self.ctrl, filename, 1)
             self.plans[filename] = plan
 
-        data = yield plan.future
-        return data
+        self._touch(filename)
+        meta = yield plan.request()
+
+        # Plan files lost before they were read, plan again on next request
+        if meta is None and self.plans.get(filename) is plan:
+            del self.plans[filename]
+            self.loaded.pop(filename, None)
+
+        return meta
 
 
     def get_plan_progress(self, filename):
         return self.plans[filename].progress if filename in self.plans else 0
+
+
+    def get_plan_vertices(self, filename):
+        return self.plans[filename].vertices if filename in self.plans else 0
+
+
+    def get_plan_estimate(self, filename):
+        if filename in self.plans: return self.plans[filename].get_estimate()
+
+
+    @gen.coroutine
+    def get_plan_partial(self, filename, name, start):
+        if not filename in self.plans: return b'', start
+        data = yield self.plans[filename].read_partial(name, start)
+        return data
+
+
+    def get_plan_path(self, filename, lod = 0):
+        plan = self.plans.get(filename)
+        if plan is not None and plan.ready: return plan.get_path(lod)
+
+
+    def _lookup_hash(self, filename):
+        # Plan hash from cached fingerprints without reading the file
+        try:
+            fp = self.fingerprints.lookup(self.ctrl.get_upload(filename))
+        except OSError: return
+
+        if fp is not None:
+            return plan_hash(fp['hash'], get_plan_config(self.ctrl),
+                             get_plan_limits(self.ctrl))
+
+
+    def _read_plan_file(self, filename, ext):
+        # Returns the contents of a finished plan's file or None
+        plan = self.plans.get(filename)
+        if plan is not None and plan.ready: hid = plan.hid
+        else: hid = self._lookup_hash(filename)
+
+        if hid is None or not self.cache.has(hid): return
+
+        try:
+            with open(self.cache.path(hid, ext), 'rb') as f:
+                data = f.read()
+                if ext == 'meta.json': return data
+                return PathFormat.decompress(data)
+
+        except Exception as e:
+            self.log.warning('Failed to read plan %s: %s', ext, e)
+
+
+    def get_plan_meta(self, filename):
+        data = self._read_plan_file(filename, 'meta.json')
+        if data is not None: return json.loads(data.decode('utf8'))
+
+
+    def check_limits(self, filename):
+        # Returns a message for each axis the planned path takes outside the
+        # soft limits of the homed axes, allowing for changed work offsets
+        meta = self.get_plan_meta(filename)
+        if meta is None: return []
+
+        state = self.ctrl.state
+        minLimit = state.get_soft_limit_vector('tn', -math.inf)
+        maxLimit = state.get_soft_limit_vector('tm', math.inf)
+        errors = []
+
+        for axis in 'xyz':
+            if maxLimit[axis] <= minLimit[axis]: continue # No limit
+            if not axis in meta['bounds']['min']: continue
+
+            shift = state.get('offset_' + axis, 0) - meta['offsets'][axis]
+            low = meta['bounds']['min'][axis] + shift
+            high = meta['bounds']['max'][axis] + shift
+            if minLimit[axis] <= low and high <= maxLimit[axis]: continue
+
+            msg = '%s axis leaves the soft limits %0.3f to %0.3f' % (
+                axis.upper(), minLimit[axis], maxLimit[axis])
+
+            # The first offending line is known if nothing changed
+            v = meta['violations'].get(axis)
+            if v is not None and not shift and \
+                    v['limit'] in (minLimit[axis], maxLimit[axis]):
+                msg += ' at line %d' % v['line']
+
+            errors.append(msg)
+
+        return errors
+
+
+    def get_plan_times(self, filename):
+        data = self._read_plan_file(filename, 'times.bin')
+        if data is not None: return PathFormat.decode_times(data)
+
+
+    def get_checkpoint(self, filename, line):
+        # Returns the last checkpoint at or before line, or None
+        data = self._read_plan_file(filename, 'checkpoints.bin')
+        if data is None: return
+        data = json.loads(data.decode('utf8'))
+
+        cp = None
+        for checkpoint in data['checkpoints']:
+            if line < checkpoint['line']: break
+            cp = checkpoint
+
+        if cp is None: return
+
+        # Shift positions by any change in work offsets since planning
+        for axis, value in cp['position'].items():
+            offset = self.ctrl.state.get('offset_' + axis, 0)
+            cp['position'][axis] = value + offset - data['offsets'][axis]
+
+        if cp['safe_z'] is not None:
+            offset = self.ctrl.state.get('offset_z', 0)
+            cp['safe_z'] += offset - data['offsets']['z']
+
+        return cp
+
+
+    def get_plan_queue(self, filename):
+        # Position 0 means the plan is being computed or is finished
+        plan = self.plans.get(filename)
+        if plan is None: return dict(position = None, eta = None)
+
+        if plan.ready or plan.worker is not None:
+            return dict(position = 0, eta = plan.remaining(self.rate))
+
+        queue = self._sorted_queue()
+        if not plan in queue: return dict(position = None, eta = None)
+        position = queue.index(plan) + 1
+
+        # Work ahead of this plan is shared between the workers
+        ahead = self._active_plans() + queue[:position]
+        remaining = [p.remaining(self.rate) for p in ahead]
+        if None in remaining: eta = None
+        else: eta = sum(remaining) / self.pool.size
+
+        return dict(position = position, eta = eta)
@@ -25,13 +25,20 @@
 #                                                                              #
 ################################################################################
 
+import re
 import traceback
 import bbctrl
 
+from tornado import gen
 from tornado.web import HTTPError
+import tornado.ioloop
+import tornado.iostream
 import tornado.web
 
 
+reRange = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
 class RequestHandler(tornado.web.RequestHandler):
     def __init__(self, app, request, **kwargs):
         super().__init__(app, request, **kwargs)
@@ -61,3 +68,75 @@ class RequestHandler(tornado.web.RequestHandler):
         log.error(str(value))
         trace = ''.join(traceback.format_exception(typ, value, tb))
         log.debug(trace)
+
+
+    def check_etag(self, etag):
+        # Returns True if the client's copy is current and a 304 was set
+        self.set_header('ETag', etag)
+
+        if self.check_etag_header():
+            self.set_status(304)
+            return True
+
+        return False
+
+
+    def get_range(self, size):
+        # Returns the requested (start, end) byte range or None for all of it
+        header = self.request.headers.get('Range')
+        if header is None: return
+
+        # Send everything if the client's partial copy is stale
+        if_range = self.request.headers.get('If-Range')
+        if if_range is not None and if_range != self._headers.get('Etag'):
+            return
+
+        m = reRange.match(header.strip())
+        if m is None: return # Multiple ranges are not supported
+        start, end = m.groups()
+
+        if start:
+            start = int(start)
+            end = min(int(end) + 1, size) if end else size
+
+        elif end: start, end = max(size - int(end), 0), size
+        else: return
+
+        return start, end
+
+
+    @gen.coroutine
+    def send_file(self, f, size, chunk_size = 102400):
+        # Streams the file object in chunks, honoring byte range requests
+        self.set_header('Accept-Ranges', 'bytes')
+        r = self.get_range(size)
+
+        if r is None: start, end = 0, size
+        else:
+            start, end = r
+
+            if end <= start:
+                self.set_status(416)
+                self.set_header('Content-Range', 'bytes */%d' % size)
+                return
+
+            self.set_status(206)
+            self.set_header('Content-Range',
+                            'bytes %d-%d/%d' % (start, end - 1, size))
+
+        self.set_header('Content-Length', str(end - start))
+        f.seek(start)
+        remaining = end - start
+        ioloop = tornado.ioloop.IOLoop.current()
+
+        try:
+            while remaining:
+                # Disk reads can stall, keep them off the ioloop
+                chunk = yield ioloop.run_in_executor(
+                    None, f.read, min(remaining, chunk_size))
+                if not chunk: break
+                remaining -= len(chunk)
+                self.write(chunk)
+                yield self.flush()
+
+        except tornado.iostream.StreamClosedError: pass
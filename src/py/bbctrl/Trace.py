@@ -0,0 +1,87 @@
+################################################################################
+#                                                                              #
+#                This file is part of the Buildbotics firmware.                #
+#                                                                              #
+#                  Copyright (c) 2015 - 2018, Buildbotics LLC                  #
+#                             All rights reserved.                             #
+#                                                                              #
+#     This file ("the software") is free software: you can redistribute it     #
+#     and/or modify it under the terms of the GNU General Public License,      #
+#      version 2 as published by the Free Software Foundation. You should      #
+#      have received a copy of the GNU General Public License, version 2       #
+#     along with the software. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                              #
+#     The software is distributed in the hope that it will be useful, but      #
+#          WITHOUT ANY WARRANTY; without even the implied warranty of          #
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU       #
+#               Lesser General Public License for more details.                #
+#                                                                              #
+#       You should have received a copy of the GNU Lesser General Public       #
+#                License along with the software.  If not, see                 #
+#                       <http://www.gnu.org/licenses/>.                        #
+#                                                                              #
+#                For information regarding this software email:                #
+#                  "Joseph Coffland" <joseph@buildbotics.com>                  #
+#                                                                              #
+################################################################################
+
+import os
+import json
+import time
+import datetime
+from collections import deque
+from bbctrl.Planner import log_json
+
+
+# Recent commands and planner blocks are kept as (time, kind, data) tuples and
+# only formatted when the trace is dumped, after an error, an estop or for a
+# bug report.  This costs far less than logging every move.
+class Trace(object):
+    def __init__(self, ctrl, size = 4096):
+        self.log = ctrl.log.get('Trace')
+        self.path = ctrl.get_path(filename = 'trace.log')
+        self.ring = deque(maxlen = size)
+        self.count = 0
+        self.dumped = 0
+
+
+    def get_path(self): return self.path
+
+
+    def add(self, kind, data):
+        self.ring.append((time.time(), kind, data))
+        self.count += 1
+
+
+    def _format(self, kind, data):
+        if kind == 'Cmd': return 'Cmd:' + log_json(data)
+        if kind == '<': return '< ' + json.dumps(data).strip('"')
+        return kind + ' ' + data
+
+
+    def format(self):
+        for t, kind, data in self.ring:
+            t = datetime.datetime.fromtimestamp(t).strftime('%H:%M:%S.%f')
+            yield '%s %s\n' % (t[:-3], self._format(kind, data))
+
+
+    def dump(self, reason):
+        # Nothing new since the last dump
+        if self.count == self.dumped: return
+        self.dumped = self.count
+
+        try:
+            # Keep the previous dump
+            if os.path.exists(self.path):
+                os.replace(self.path, self.path + '.1')
+
+            with open(self.path, 'w') as f:
+                now = datetime.datetime.now().strftime('%Y/%m/%d %H:%M:%S')
+                f.write('Trace dumped on %s at %s\n' % (reason, now))
+                f.writelines(self.format())
+
+            self.log.info('Dumped %d trace entries on %s to %s',
+                          len(self.ring), reason, self.path)
+
+        except Exception as e:
+            self.log.warning('Failed to dump trace: %s', e)
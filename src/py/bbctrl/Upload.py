@@ -0,0 +1,233 @@
+################################################################################
+#                                                                              #
+#                This file is part of the Buildbotics firmware.                #
+#                                                                              #
+#                  Copyright (c) 2015 - 2018, Buildbotics LLC                  #
+#                             All rights reserved.                             #
+#                                                                              #
+#     This file ("the software") is free software: you can redistribute it     #
+#     and/or modify it under the terms of the GNU General Public License,      #
+#      version 2 as published by the Free Software Foundation. You should      #
+#      have received a copy of the GNU General Public License, version 2       #
+#     along with the software. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                              #
+#     The software is distributed in the hope that it will be useful, but      #
+#          WITHOUT ANY WARRANTY; without even the implied warranty of          #
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU       #
+#               Lesser General Public License for more details.                #
+#                                                                              #
+#       You should have received a copy of the GNU Lesser General Public       #
+#                License along with the software.  If not, see                 #
+#                       <http://www.gnu.org/licenses/>.                        #
+#                                                                              #
+#                For information regarding this software email:                #
+#                  "Joseph Coffland" <joseph@buildbotics.com>                  #
+#                                                                              #
+################################################################################
+
+import os
+import time
+import zlib
+import queue
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import bbctrl.GCodeScan as GCodeScan
+from bbctrl.FingerprintCache import Fingerprint
+from bbctrl.Preplanner import get_plan_config, get_scan_args
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Received data not yet on disk before reading from the network is paused
+MAX_BUFFER = 8 * 1024 * 1024
+
+# Compressed upload file extensions
+extensions = {'.gz': 'gzip', '.zst': 'zstd'}
+
+
+def get_encoding(filename, content_encoding = None):
+    # Returns the upload's compression and the name to save it as
+    if content_encoding in ('gzip', 'x-gzip'): return 'gzip', filename
+    if content_encoding == 'zstd': return 'zstd', filename
+
+    ext = os.path.splitext(filename)[1].lower()
+    if ext in extensions: return extensions[ext], filename[:-len(ext)]
+
+    return None, filename
+
+
+class GzipDecoder(object):
+    # Decodes gzip streams of one or more members
+    def __init__(self): self.d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+
+    def decompress(self, data):
+        out = []
+
+        while data:
+            out.append(self.d.decompress(data))
+            data = self.d.unused_data
+
+            if data: self.d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+        return b''.join(out)
+
+
+    def flush(self):
+        if not self.d.eof: raise Exception('Compressed upload is truncated')
+        return self.d.flush()
+
+
+def get_decoder(encoding):
+    if encoding == 'gzip': return GzipDecoder()
+
+    if encoding == 'zstd':
+        if zstandard is None: raise Exception('zstd uploads not supported')
+        return zstandard.ZstdDecompressor().decompressobj()
+
+
+def follow_lines(f, sizes):
+    # Yields the lines of a file as it is written.  Each size received is the
+    # file length so far, None marks the end.
+    rest = b''
+
+    with f:
+        for size in iter(sizes.get, None):
+            data = rest + f.read(size - f.tell())
+            lines = data.split(b'\n')
+            rest = lines.pop()
+
+            for line in lines: yield line.decode('utf8', errors = 'replace')
+
+        rest += f.read()
+        if rest: yield rest.decode('utf8', errors = 'replace')
+
+
+# An upload in progress.  Received pieces are decompressed if necessary,
+# written to a temporary file and added to the content fingerprint by a writer
+# thread so slow SD card writes do not stall the ioloop.  A quick scan follows
+# the file in another thread, so the upload can be planned as soon as the last
+# piece arrives.
+class Upload(object):
+    def __init__(self, ctrl, filename, encoding = None):
+        self.log = ctrl.log.get('Upload')
+        self.filename = filename
+        self.decoder = get_decoder(encoding)
+        self.file = tempfile.NamedTemporaryFile('wb')
+        self.fp = Fingerprint()
+        self.size = 0 # Bytes received
+        self.written = 0 # Bytes of GCode written
+        self.fingerprint = None
+        self.error = None
+        self.closed = False
+
+        # Writes not yet finished and their sizes
+        self.writes = deque()
+        self.buffered = 0
+        self.start = time.time()
+        self.stalled = 0
+
+        state = ctrl.state.snapshot()
+        self.scan_args = get_scan_args(state, get_plan_config(ctrl))
+
+        # Opened here so the scan can still read if the upload is removed
+        self.sizes = queue.Queue()
+        lines = follow_lines(open(self.file.name, 'rb'), self.sizes)
+
+        executor = ThreadPoolExecutor(1)
+        self.estimate = executor.submit(GCodeScan.scan_lines, lines, filename,
+                                        *self.scan_args)
+        executor.shutdown(wait = False) # Exit when the scan is done
+
+        self.writer = ThreadPoolExecutor(1)
+
+
+    def _write(self, data, last = False):
+        # Runs in the writer thread
+        if self.error is not None: return
+
+        try:
+            if self.decoder is not None:
+                data = self.decoder.decompress(data)
+                if last: data += self.decoder.flush()
+
+            self.file.write(data)
+            self.file.flush()
+            self.fp.update(data)
+            self.written += len(data)
+            self.sizes.put(self.written)
+
+        except Exception as e: self.error = e
+
+
+    def _flush(self):
+        self._write(b'', True)
+        if self.error is not None: raise self.error
+
+
+    def _close(self):
+        self.sizes.put(None)
+        self.file.close()
+
+
+    def _resumed(self, start):
+        self.stalled += time.time() - start
+
+
+    def write(self, data):
+        # Returns a Future to wait on before reading more when the writer
+        # has fallen behind
+        if self.error is not None: raise self.error
+
+        self.size += len(data)
+        future = self.writer.submit(self._write, data)
+        self.writes.append((future, len(data)))
+        self.buffered += len(data)
+
+        while self.writes and self.writes[0][0].done():
+            self.buffered -= self.writes.popleft()[1]
+
+        if self.buffered <= MAX_BUFFER: return
+
+        # Resume once half the buffer is written
+        remaining = self.buffered
+        for future, size in self.writes:
+            remaining -= size
+            if remaining <= MAX_BUFFER / 2: break
+
+        start = time.time()
+        future.add_done_callback(lambda f: self._resumed(start))
+        return future
+
+
+    def flush(self):
+        # Returns a Future which is done when all data is written
+        return self.writer.submit(self._flush)
+
+
+    def save(self, path):
+        # Must be flushed first
+        os.link(self.file.name, path)
+        self.fingerprint = self.fp.result()
+        self.close()
+
+        elapsed = max(time.time() - self.start, 0.001)
+        MiB = self.size / 1024 / 1024
+        self.log.info('Uploaded %s: %.1f MiB in %.1fs, %.2f MiB/s, '
+                      'stalled %.1fs', self.filename, MiB, elapsed,
+                      MiB / elapsed, self.stalled)
+
+        if self.decoder is not None:
+            self.log.info('Decompressed %s to %.1f MiB', self.filename,
+                          self.written / 1024 / 1024)
+
+
+    def close(self):
+        if self.closed: return
+        self.closed = True
+        self.writer.submit(self._close)
+        self.writer.shutdown(wait = False)
@@ -11,11 +11,15 @@ from tornado import gen
 from tornado.escape import url_unescape
 import re
 import bbctrl
+import bbctrl.PathFormat as PathFormat
+from bbctrl.FingerprintCache import read_lines
 from urllib.request import urlopen
 import iw_parse
 import io
+import gzip
 import zipfile
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 
 def call_get_output(cmd):
     p = subprocess.Popen(cmd, stdout = subprocess.PIPE)
@@ -49,6 +53,17 @@ def check_password(password):
     if s.split('$') != current: raise HTTPError(401, 'Wrong password')
 
 
+def gzip_compress(data, level = 1):
+    # Fixed mtime so repeated responses are byte identical
+    buf = io.BytesIO()
+
+    with gzip.GzipFile(fileobj = buf, mode = 'wb', compresslevel = level,
+                       mtime = 0) as f:
+        f.write(data)
+
+    return buf.getvalue()
+
+
 
 class RebootHandler(bbctrl.APIHandler):
     def put_ok(self):
@@ -94,6 +109,11 @@ class BugReportHandler(bbctrl.RequestHandler):
             check_add(path, os.path.basename(path))
 
         ctrl = self.get_ctrl()
+        ctrl.trace.dump('bug report')
+        path = ctrl.trace.get_path()
+        check_add_basename(path)
+        check_add_basename(path + '.1')
+
         path = ctrl.log.get_path()
         check_add_basename(path)
         for i in range(1, 8):
@@ -396,7 +416,60 @@ class UpgradeHandler(bbctrl.APIHandler):
         subprocess.Popen(['/usr/local/bin/upgrade-bbctrl'])
 
 
+class FileLinesHandler(bbctrl.APIHandler):
+    @gen.coroutine
+    def get(self, filename):
+        path = self.get_upload(os.path.basename(filename))
+        if not os.path.isfile(path): raise HTTPError(404, 'File not found')
+
+        try:
+            start = max(1, int(self.get_query_argument('start', 1)))
+            count = min(max(0, int(self.get_query_argument('count', 100))),
+                        10000)
+        except ValueError: raise HTTPError(400, 'Invalid line range')
+
+        fingerprints = self.get_ctrl().preplanner.fingerprints
+        fp, index = yield fingerprints.get_index(path)
+        lines = read_lines(path, index, start, count)
+
+        self.write_json(dict(start = start, total = fp['lines'],
+                             lines = lines))
+
+
 class PathHandler(bbctrl.APIHandler):
+    # Decodes plans off the ioloop so serial I/O is not held up
+    executor = ThreadPoolExecutor(1)
+
+
+    def _write_partial(self, data, vertices, complete):
+        self.set_header('Content-Type', 'application/octet-stream')
+        self.set_header('X-Vertices', str(vertices))
+        self.set_header('X-Complete', 'true' if complete else 'false')
+        self.write(data)
+
+
+    def _open_plan(self, filename, lod = 0):
+        path = self.get_ctrl().preplanner.get_plan_path(filename, lod)
+
+        try:
+            if path is not None: return open(path, 'rb')
+        except FileNotFoundError:
+            # Evicted from the plan cache, plan it again
+            self.get_ctrl().preplanner.invalidate(filename)
+
+        raise HTTPError(404, 'Plan not found')
+
+
+    def _decode(self, f, name):
+        # Runs in the executor
+        data = PathFormat.decompress(f.read())
+        if name == 'path': return data
+
+        # Float32 geometry for clients without a path format decoder
+        data = PathFormat.decode(data)
+        return gzip_compress(data[0 if name == 'positions' else 1])
+
+
     @gen.coroutine
     def get(self, filename, dataType, *args):
         if not os.path.exists(self.get_upload(filename)):
@@ -405,40 +478,85 @@ class PathHandler(bbctrl.APIHandler):
         preplanner = self.get_ctrl().preplanner
         future = preplanner.get_plan(filename)
 
+        # Geometry from vertex offset, available while still planning
+        start = self.get_query_argument('from', None)
+        if start is not None and dataType in ('/positions', '/speeds'):
+            start = int(start)
+            name = dataType[1:]
+
+            if future.done():
+                # Decoding the whole plan is slow, the client should switch
+                # to the complete path
+                meta = future.result()
+                if meta is None: return
+                self.set_header('X-Path', '/api/path/%s/path' % filename)
+                vertices = meta.get('lods', [{}])[0].get('vertices', start)
+                self._write_partial(b'', vertices, True)
+
+            else:
+                data, vertices = \
+                    yield preplanner.get_plan_partial(filename, name, start)
+                self._write_partial(data, vertices, False)
+
+            return
+
         try:
             delta = datetime.timedelta(seconds = 1)
-            data = yield gen.with_timeout(delta, future)
+            meta = yield gen.with_timeout(delta, future)
 
         except gen.TimeoutError:
             progress = preplanner.get_plan_progress(filename)
-            self.write_json(dict(progress = progress))
+            vertices = preplanner.get_plan_vertices(filename)
+            queue = preplanner.get_plan_queue(filename)
+            estimate = preplanner.get_plan_estimate(filename)
+            self.write_json(dict(progress = progress, vertices = vertices,
+                                 queue = queue['position'], eta = queue['eta'],
+                                 estimate = estimate))
             return
 
-        try:
-            if data is None: return
-            meta, positions, speeds = data
+        if meta is None: return
 
-            if dataType == '/positions': data = positions
-            elif dataType == '/speeds': data = speeds
+        if not dataType:
+            self.get_ctrl().state.set_bounds(meta['bounds'])
+            self.write_json(meta)
+            return
+
+        # Simplified geometry, 0 is full detail
+        lod = self.get_query_argument('lod', '0')
+        if not lod.isdigit() or bbctrl.PlanCache.lods < int(lod):
+            raise HTTPError(400, 'Invalid level of detail')
+
+        lod = int(lod)
+        name = dataType[1:]
+        accept = self.request.headers.get('Accept-Encoding', '')
+
+        with self._open_plan(filename, lod) as f:
+            encoding = PathFormat.get_encoding(f.read(4))
+            f.seek(0)
+
+            raw = name == 'path' and (encoding != 'zstd' or 'zstd' in accept)
+            if not raw: encoding = None if name == 'path' else 'gzip'
+
+            # Plan files are content addressed so the name is a strong ETag
+            etag = '"%s-%s-%s"' % (os.path.basename(f.name), name,
+                                   encoding or 'identity')
+            self.set_header('Vary', 'Accept-Encoding')
+            if self.check_etag(etag): return
+
+            if raw: src, size = f, os.fstat(f.fileno()).st_size
             else:
-                self.get_ctrl().state.set_bounds(meta['bounds'])
-                self.write_json(meta)
-                return
+                data = yield self.executor.submit(self._decode, f, name)
+                src, size = io.BytesIO(data), len(data)
 
-            filename = filename + '-' + dataType[1:]
+            if lod: filename = '%s-%d' % (filename, lod)
+            filename = filename + '-' + name
             self.set_header('Content-Disposition', 'filename="%s"' % filename)
             self.set_header('Content-Type', 'application/octet-stream')
-            self.set_header('Content-Encoding', 'gzip')
-            self.set_header('Content-Length', str(len(data)))
-
-            # Respond with chunks to avoid long delays
-            SIZE = 102400
-            chunks = [data[i:i + SIZE] for i in range(0, len(data), SIZE)]
-            for chunk in chunks:
-                self.write(chunk)
-                yield self.flush()
+            if encoding is not None:
+                self.set_header('Content-Encoding', encoding)
 
-        except tornado.iostream.StreamClosedError as e: pass
+            # Stream from disk in chunks rather than holding plans in memory
+            yield self.send_file(src, size)
 
 
 class HomeHandler(bbctrl.APIHandler):
@@ -456,7 +574,10 @@ class HomeHandler(bbctrl.APIHandler):
 
 
 class StartHandler(bbctrl.APIHandler):
-    def put_ok(self): self.get_ctrl().mach.start()
+    @gen.coroutine
+    def put(self):
+        yield self.get_ctrl().mach.start(self.json.get('line'))
+        self.write_json('ok')
 
 
 class EStopHandler(bbctrl.APIHandler):
@@ -919,8 +1040,9 @@ class Web(tornado.web.Application):
             (r'/api/config/restore',ConfigRestoreHandler),
             (r'/api/firmware/update', FirmwareUpdateHandler),
             (r'/api/upgrade', UpgradeHandler),
+            (r'/api/file/([^/]+)/lines', FileLinesHandler),
             (r'/api/file(/[^/]+)?', bbctrl.FileHandler),
-            (r'/api/path/([^/]+)((/positions)|(/speeds))?', PathHandler),
+            (r'/api/path/([^/]+)((/positions)|(/speeds)|(/path))?', PathHandler),
             (r'/api/home(/[xyzabcXYZABC]((/set)|(/clear))?)?', HomeHandler),
             (r'/api/start', StartHandler),
             (r'/api/estop', EStopHandler),
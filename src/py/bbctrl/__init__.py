@@ -48,7 +48,12 @@ from bbctrl.Ctrl import Ctrl
 from bbctrl.Pwr import Pwr
 from bbctrl.I2C import I2C
 from bbctrl.Planner import Planner
+from bbctrl.Trace import Trace
 from bbctrl.Preplanner import Preplanner
+from bbctrl.PlanWorker import PlanWorker, PlanWorkerPool
+from bbctrl.PlanCache import PlanCache
+from bbctrl.FingerprintCache import FingerprintCache
+from bbctrl.Upload import Upload
 from bbctrl.State import State
 from bbctrl.Comm import Comm
 from bbctrl.CommandQueue import CommandQueue
@@ -142,6 +147,8 @@ def parse_args():
                         help = 'Verbose output')
     parser.add_argument('-l', '--log', metavar = "FILE",
                         help = 'Set a log file')
+    parser.add_argument('--log-commands', action = 'store_true',
+                        help = 'Log every command sent to the AVR')
     parser.add_argument('--disable-camera', action = 'store_true',
                         help = 'Disable the camera')
     parser.add_argument('--width', default = 640, type = int,
@@ -158,6 +165,10 @@ def parse_args():
                         help = 'Enable debug mode and set frequency in seconds')
     parser.add_argument('--fast-emu', action = 'store_true',
                         help = 'Enter demo mode')
+    parser.add_argument('--plan-workers', default = 1, type = int,
+                        help = 'Number of background GCode planner processes')
+    parser.add_argument('--plan-cache-size', default = 256, type = int,
+                        help = 'Plan cache disk budget in MiB')
     parser.add_argument('--client-timeout', default = 5 * 60, type = int,
                         help = 'Demo client timeout in seconds')
 
@@ -34,9 +34,11 @@ import time
 import math
 import os
 import re
-import gzip
 import struct
-import math
+import signal
+import hashlib
+from array import array
+import PathFormat
 import camotics.gplan as gplan # pylint: disable=no-name-in-module,import-error
 
 
@@ -48,46 +50,240 @@ reLogLine = re.compile(
     r'(?P<msg>.*)$')
 
 
-def compute_unit(a, b):
-    unit = dict()
-    length = 0
-
-    for axis in 'xyz':
-        if axis in a and axis in b:
-            unit[axis] = b[axis] - a[axis]
-            length += unit[axis] * unit[axis]
-
-    length = math.sqrt(length)
-
-    if length:
-        for axis in 'xyz':
-            if axis in unit: unit[axis] /= length
-
-    return unit
-
+class PlanCancelled(Exception): pass
+
 
-def compute_move(start, unit, dist):
-    move = dict()
+# Maximum deviation in mm of each level-of-detail path, finest first
+LOD_TOLERANCES = (0.05, 0.25, 1)
 
-    for axis in 'xyz':
-        if axis in unit and axis in start:
-            move[axis] = start[axis] + unit[axis] * dist
+# Minimum planned seconds between line time table entries
+LINE_TIME_STEP = 1
 
-    return move
+# Minimum GCode lines between resume checkpoints
+CHECKPOINT_LINES = 250
+
+# Vertices accumulated before geometry is flushed to the streams and encoders
+BLOCK_VERTICES = 8192
+
+# Planner commands between checks of the planning time limits and progress
+CLOCK_CMDS = 64
+
+reWord = re.compile(r'([A-Z#])\s*([-+]?[0-9.]*)')
+reComment = re.compile(r'\([^)]*\)|;.*$')
+
+modalGroups = dict(
+    units = ('20', '21'),
+    distance = ('90', '91'),
+    coords = ('54', '55', '56', '57', '58', '59', '59.1', '59.2', '59.3'),
+    plane = ('17', '18', '19'),
+    feed_mode = ('93', '94'),
+    motion = ('0', '1', '2', '3', '80'))
+
+# Motion modes which cannot be restored by a resume, such as probing and
+# canned cycles
+otherMotion = ('38.2', '38.3', '38.4', '38.5', '73', '76', '81', '82', '83',
+               '84', '85', '86', '87', '88', '89')
+
+
+# Simplifies a vertex stream by dropping vertices which fall in the same grid
+# cell as the last vertex kept.  Each dropped vertex lies within one cell
+# diagonal of the segment starting at that kept vertex so the cell size bounds
+# the error.  Rapids and both ends of every speed change are always kept.
+class Decimator(object):
+    def __init__(self, tolerance, rapid):
+        self.tolerance = tolerance
+        self.cell = tolerance / math.sqrt(3)
+        self.rapid = rapid
+        self.key = None
+        self.lastS = None
+        self.held = None
+        self.encoder = PathFormat.Encoder()
+
+
+    # ``bits`` holds the float32 speeds as integers so NaNs compare equal
+    def add_block(self, positions, speeds, bits):
+        inv = 1 / self.cell
+        floor = math.floor
+        keys = zip(*[[floor(v * inv) for v in positions[axis::3]]
+                     for axis in range(3)])
+
+        outPos = array('d')
+        outSpeeds = array('f')
+        key = self.key
+        lastS = self.lastS
+        rapid = self.rapid
+        held = self.held # Carried over from the previous block
+        h = -1
+
+        for i, k in enumerate(keys):
+            s = bits[i]
+
+            if s != lastS or s == rapid:
+                if 0 <= h:
+                    outPos.extend(positions[3 * h:3 * h + 3])
+                    outSpeeds.append(speeds[h])
+
+                elif held is not None:
+                    outPos.extend(held[0])
+                    outSpeeds.append(held[1])
+
+            elif k == key:
+                h = i
+                held = None
+                continue
+
+            outPos.extend(positions[3 * i:3 * i + 3])
+            outSpeeds.append(speeds[i])
+            h = -1
+            held = None
+            key = k
+            lastS = s
+
+        if 0 <= h: held = (positions[3 * h:3 * h + 3], speeds[h])
+
+        self.key = key
+        self.lastS = lastS
+        self.held = held
+        if outSpeeds: self.encoder.add_block(outPos, outSpeeds)
+
+
+    def finish(self):
+        if self.held is not None:
+            self.encoder.add_block(array('d', self.held[0]),
+                                   array('f', [self.held[1]]))
+        self.held = None
+
+
+# Tracks the modal GCode state needed to resume a program part way through.
+# Programs which use subroutines, parameters or G10/G92 offsets cannot be
+# resumed from the text alone and are marked unsupported.  The byte offset and
+# a hash of the text since the last segment are kept so a later version of
+# the file can be checked for an unchanged beginning.
+class ModalScanner(object):
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.line = 0
+        self.offset = 0
+        self.hash = hashlib.sha256()
+        self.unsupported = False
+        self.modal = {}
+        self.feed = None
+        self.plunge_feed = None # Feed of the last Z only G1 move
+        self.plunge_units = None
+        self.speed = None
+        self.tool = None
+        self.spindle = None
+        self.mist = False
+        self.flood = False
+
+
+    def _scan(self, text):
+        text = reComment.sub('', text.upper())
+        axes = set()
+
+        for letter, value in reWord.findall(text):
+            if letter in 'O#':
+                self.unsupported = True
+                return
+
+            try:
+                number = float(value)
+            except ValueError: continue
+
+            if letter == 'G':
+                code = ('%.1f' % number).rstrip('0').rstrip('.')
+                if code in ('10', '92'): self.unsupported = True
+                if code in otherMotion: self.modal.pop('motion', None)
+
+                for group, codes in modalGroups.items():
+                    if code in codes: self.modal[group] = 'G' + code
+
+            elif letter == 'M':
+                if number in (3, 4, 5): self.spindle = 'M%d' % number
+                if number == 7: self.mist = True
+                if number == 8: self.flood = True
+                if number == 9: self.mist = self.flood = False
+
+            elif letter == 'F': self.feed = number
+            elif letter == 'S': self.speed = number
+            elif letter == 'T': self.tool = int(number)
+            elif letter in 'XYZABC': axes.add(letter)
+
+        if axes == {'Z'} and self.modal.get('motion') == 'G1':
+            self.plunge_feed = self.feed
+            self.plunge_units = self.modal.get('units')
+
+
+    def advance(self, line):
+        # Scan all lines before ``line``
+        while not self.unsupported and self.line < line - 1:
+            text = self.file.readline()
+            if not text: break
+            self.line += 1
+            self.offset += len(text)
+            self.hash.update(text)
+            self._scan(text.decode('utf8', errors = 'replace'))
+
+
+    def segment(self):
+        # Returns the offset and hash of the text since the last segment
+        digest = self.hash.hexdigest()
+        self.hash = hashlib.sha256()
+        return dict(offset = self.offset, hash = digest)
+
+
+    def resume(self, cp):
+        # Continue from a checkpoint's state
+        self.file.seek(cp['offset'])
+        self.line = cp['line'] - 1
+        self.offset = cp['offset']
+        self.modal = dict(cp['modal'])
+        for name in ('feed', 'plunge_feed', 'plunge_units', 'speed', 'tool',
+                     'spindle', 'mist', 'flood'):
+            setattr(self, name, cp[name])
+
+
+    def get_state(self):
+        return dict(modal = dict(self.modal), feed = self.feed,
+                    plunge_feed = self.plunge_feed,
+                    plunge_units = self.plunge_units,
+                    speed = self.speed, tool = self.tool,
+                    spindle = self.spindle, mist = self.mist,
+                    flood = self.flood)
+
+
+    def close(self): self.file.close()
 
 
 class Plan(object):
-    def __init__(self, path, state, config):
+    def __init__(self, path, state, config, max_time = 600, max_loop = 30,
+                 worker = False, lines = None, limits = None, base = None):
         self.path = path
+        self.base = base
         self.state = state
         self.config = config
+        self.limits = limits or dict(min = {}, max = {})
+        self.violations = {}
+        self.max_time = max_time
+        self.max_loop = max_loop
+        self.worker = worker
+        self.cancelled = False
 
-        self.lines = sum(1 for line in open(path, 'rb'))
+        if lines is not None: self.lines = lines
+        else:
+            with open(path, 'rb') as f: self.lines = sum(1 for line in f)
 
         self.planner = gplan.Planner()
         self.planner.set_resolver(self.get_var_cb)
         self.planner.set_logger(self._log_cb, 1, 'LinePlanner:3')
-        self.planner.load(self.path, config)
+        self.planner.load(base['gcode'] if base else path, config)
+
+        # A base plan's geometry is reused up to its checkpoint at first_line.
+        # The GCode planned is a preamble which restores the checkpoint's state
+        # followed by the rest of the file so line numbers are offset.
+        self.first_line = base['line'] if base else 0
+        self.line_offset = base['line'] - 1 - base['preamble'] if base else 0
+        self.position = {}
 
         self.messages = []
         self.levels = dict(I = 'info', D = 'debug', W = 'warning', E = 'error',
@@ -104,6 +300,23 @@ class Plan(object):
         self.lastProgress = None
         self.lastProgressTime = 0
         self.time = 0
+        self.vertices = 0
+        self.streams = None
+        self.time_lines = []
+        self.line_times = []
+        self.scanner = ModalScanner(path)
+        self.checkpoints = []
+        self.encoder = None
+        self.lods = []
+
+        # Vertices not yet flushed, the index of the first vertex at which
+        # each axis position is known and the last vertex speed
+        self.block = array('d')
+        self.block_speeds = array('f')
+        self.known = {}
+        self.last = None
+        self.lastSpeed = None
+        self.lastBits = None
 
 
     def add_to_bounds(self, axis, value):
@@ -169,29 +382,191 @@ class Plan(object):
         if line is not None: line = int(line)
         if column is not None: column = int(column)
 
+        if self.base is not None:
+            # Report against the original file and ignore the preamble
+            filename = os.path.basename(self.path)
+            if line is not None:
+                line += self.line_offset
+                if line < self.first_line: return
+
         self.log_cb(level, msg, filename, line, column)
 
 
     def progress(self, x):
-        if time.time() - self.lastProgressTime < 1 and x != 1: return
-        self.lastProgressTime = time.time()
+        now = time.time()
+        if now - self.lastProgressTime < 1 and x != 1: return
+        self.lastProgressTime = now
 
-        p = '%.4f\n' % x
+        p = '%.4f' % x
 
         if self.lastProgress == p: return
         self.lastProgress = p
 
-        sys.stdout.write(p)
-        sys.stdout.flush()
+        if self.worker:
+            # Make geometry written so far visible to the parent
+            if self.streams is not None:
+                self._flush_block()
+                for f in self.streams: f.flush()
+
+            write_msg(progress = float(p), vertices = self.vertices)
+
+        else:
+            sys.stdout.write(p + '\n')
+            sys.stdout.flush()
+
+
+    def check_limits(self, line, target):
+        # Record the first move outside the soft limits on each axis
+        for axis, value in target.items():
+            if axis in self.violations: continue
+            low = self.limits['min'].get(axis, -math.inf)
+            high = self.limits['max'].get(axis, math.inf)
+            if low <= value <= high: continue
+            limit = low if value < low else high
+
+            self.violations[axis] = dict(line = line, value = value,
+                                         limit = limit)
+            self.log_cb('warning', '%s=%0.3f is outside the soft limit %0.3f'
+                        % (axis.upper(), value, limit),
+                        os.path.basename(self.path), line, 0)
+
+
+    def add_line_time(self, line):
+        # Record the planned time at the start of a line
+        if self.line_times and self.time - self.line_times[-1] < LINE_TIME_STEP:
+            return
+
+        self.time_lines.append(line)
+        self.line_times.append(self.time)
+
+
+    def add_checkpoint(self, line, position):
+        last = self.checkpoints[-1]['line'] if self.checkpoints else 1
+        if line < last + CHECKPOINT_LINES: return
+
+        self.scanner.advance(line)
+        if self.scanner.unsupported: return
+
+        self._flush_block() # Update bounds
+
+        # Only axes the program has moved have a known position
+        maxZ = self.bounds['max']['z']
+        cp = dict(line = line, time = self.time,
+                  position = {axis: position[axis] for axis in 'xyz'
+                              if self.bounds['max'][axis] != -math.inf},
+                  safe_z = None if maxZ == -math.inf else maxZ,
+                  vertex = self.vertices, known = dict(self.known))
+        cp.update(self.scanner.get_state())
+        cp.update(self.scanner.segment())
+        self.checkpoints.append(cp)
+
+
+    def _add_vertex(self, x, y, z, rapid, speed):
+        key = None if rapid else speed
+        s = math.nan if rapid else speed
+
+        if key != self.lastSpeed or self.last is None:
+            bits = struct.pack('<f', s)
+
+            # Repeat the last vertex at the new speed
+            if self.last is not None and bits != self.lastBits:
+                self.block.extend(self.last)
+                self.block_speeds.append(s)
+
+            self.lastSpeed = key
+            self.lastBits = bits
+
+        self.last = (x, y, z)
+        self.block.extend(self.last)
+        self.block_speeds.append(s)
+
+
+    def _flush_block(self):
+        positions = self.block
+        speeds = self.block_speeds
+        if not speeds: return
+
+        # Bounds only include vertices after the program first set each axis
+        for i, axis in enumerate('xyz'):
+            if axis not in self.known: continue
+            first = max(self.known[axis] - self.vertices, 0)
+            values = positions[3 * first + i::3]
+
+            if values:
+                self.add_to_bounds(axis, min(values))
+                self.add_to_bounds(axis, max(values))
+
+        f1, f2 = self.streams
+        f1.write(array('f', positions).tobytes())
+        f2.write(speeds.tobytes())
+
+        self.encoder.add_block(positions, speeds)
+        bits = array('I', speeds.tobytes())
+        for lod in self.lods: lod.add_block(positions, speeds, bits)
+
+        self.vertices += len(speeds)
+        self.block = array('d')
+        self.block_speeds = array('f')
+
+
+    def _read_base(self, name):
+        with open(os.path.join(self.base['dir'], name), 'rb') as f:
+            data = f.read()
+            if name == 'meta.json': return json.loads(data.decode('utf8'))
+            return PathFormat.decompress(data)
+
+
+    def _load_base(self):
+        # Restore the base plan's results up to the resume checkpoint
+        line = self.first_line
+        data = json.loads(self._read_base('checkpoints.bin').decode('utf8'))
+        self.checkpoints = [cp for cp in data['checkpoints']
+                            if cp['line'] <= line]
+        cp = self.checkpoints[-1]
+
+        self.time = cp['time']
+        self.position = cp['position']
+        self.known = cp['known']
+        self.scanner.resume(cp)
+
+        lines, times = PathFormat.decode_times(self._read_base('times.bin'))
+        for l, t in zip(lines, times):
+            if l < line:
+                self.time_lines.append(l)
+                self.line_times.append(t)
+
+        meta = self._read_base('meta.json')
+        self.messages = [msg for msg in meta['messages']
+                         if msg['line'] is not None and msg['line'] < line]
+        self.violations = {axis: v for axis, v in meta['violations'].items()
+                           if v['line'] < line}
+
+        # Quantized geometry is passed through the encoders again
+        positions, speeds = PathFormat.decode(self._read_base('path.bin'))
+        n = cp['vertex']
+        self.block = array('d', array('f', positions[:12 * n]))
+        self.block_speeds = array('f', speeds[:4 * n])
+
+        for s in self.block_speeds:
+            if s == s and self.maxSpeed < s: self.maxSpeed = s
+
+        if n:
+            s = self.block_speeds[-1]
+            self.last = tuple(self.block[-3:])
+            self.lastSpeed = None if s != s else s
+            self.lastBits = struct.pack('<f', s)
 
 
     def _run(self):
         start = time.time()
         line = 0
-        maxLine = 0
-        maxLineTime = time.time()
-        position = {axis: 0 for axis in 'xyz'}
-        rapid = False
+        maxLine = max(self.first_line - 1, 0)
+        maxLineTime = start
+        lastLine = 0
+        count = 0
+        x, y, z = [self.position.get(axis, 0) for axis in 'xyz']
+        known = self.known
+        limits = self.limits['min'] or self.limits['max']
 
         # Execute plan
         try:
@@ -202,110 +577,224 @@ class Plan(object):
                 # Cannot synchronize with actual machine so fake it
                 if self.planner.is_synchronizing(): self.planner.synchronize(0)
 
-                if cmd['type'] == 'line':
+                if cmd['type'] == 'set' and cmd['name'] == 'line':
+                    line = cmd['value'] + self.line_offset
+                    if maxLine < line:
+                        maxLine = line
+                        self.add_line_time(line)
+                        self.add_checkpoint(line, dict(x = x, y = y, z = z))
+
+                elif line < self.first_line:
+                    # The resume preamble only moves to the base plan's end
+                    if cmd['type'] == 'line':
+                        x = cmd['target'].get('x', x)
+                        y = cmd['target'].get('y', y)
+                        z = cmd['target'].get('z', z)
+
+                    elif cmd['type'] == 'set' and cmd['name'] == 'speed':
+                        self.update_speed(cmd['value'])
+
+                elif cmd['type'] == 'line':
                     if not (cmd.get('first', False) or
                             cmd.get('seeking', False)):
                         self.time += sum(cmd['times']) / 1000
 
                     target = cmd['target']
-                    move = {}
-                    startPos = dict()
-
-                    for axis in 'xyz':
-                        if axis in target:
-                            startPos[axis] = position[axis]
-                            position[axis] = target[axis]
-                            move[axis] = target[axis]
-                            self.add_to_bounds(axis, move[axis])
-
-                    if 'rapid' in cmd: move['rapid'] = cmd['rapid']
+                    if limits: self.check_limits(line, target)
+                    x0, y0, z0 = x, y, z
+                    x = target.get('x', x)
+                    y = target.get('y', y)
+                    z = target.get('z', z)
 
                     if 'speeds' in cmd:
-                        unit = compute_unit(startPos, target)
+                        # Split the move at each speed change
+                        dx, dy, dz = x - x0, y - y0, z - z0
+                        length = math.sqrt(dx * dx + dy * dy + dz * dz)
+                        if length:
+                            dx, dy, dz = dx / length, dy / length, dz / length
 
                         for d, s in cmd['speeds']:
                             cur = self.currentSpeed
 
-                            if self.update_speed(s):
-                                m = compute_move(startPos, unit, d)
+                            if self.update_speed(s) and cur is not None:
+                                self._add_vertex(x0 + dx * d, y0 + dy * d,
+                                                 z0 + dz * d, False, cur)
 
-                                if cur is not None:
-                                    m['s'] = cur
-                                    yield m
+                    speed = self.currentSpeed
+                    self._add_vertex(x, y, z, cmd.get('rapid', False),
+                                     0 if speed is None else speed)
 
-                                move['s'] = s
+                    if len(known) < 3:
+                        for axis in 'xyz':
+                            if axis in target and axis not in known:
+                                known[axis] = \
+                                    self.vertices + len(self.block_speeds) - 1
 
-                    yield move
+                elif cmd['type'] == 'set' and cmd['name'] == 'speed':
+                    s = cmd['value']
+                    if self.update_speed(s):
+                        self._add_vertex(x, y, z, False, s)
 
-                elif cmd['type'] == 'set':
-                    if cmd['name'] == 'line':
-                        line = cmd['value']
-                        if maxLine < line:
-                            maxLine = line
-                            maxLineTime = time.time()
+                elif cmd['type'] == 'dwell': self.time += cmd['seconds']
 
-                    elif cmd['name'] == 'speed':
-                        s = cmd['value']
-                        if self.update_speed(s): yield {'s': s}
+                if BLOCK_VERTICES <= len(self.block_speeds): self._flush_block()
 
-                elif cmd['type'] == 'dwell': self.time += cmd['seconds']
+                if self.cancelled: raise PlanCancelled()
 
-                if args.max_time < time.time() - start:
+                # Only check the clock periodically
+                count += 1
+                if count % CLOCK_CMDS: continue
+
+                now = time.time()
+                if lastLine != maxLine:
+                    lastLine = maxLine
+                    maxLineTime = now
+
+                if self.max_time < now - start:
                     raise Exception('Max planning time (%d sec) exceeded.' %
-                                    args.max_time)
+                                    self.max_time)
 
-                if args.max_loop < time.time() - maxLineTime:
+                if self.max_loop < now - maxLineTime:
                     raise Exception('Max loop time (%d sec) exceeded.' %
-                                    args.max_loop)
+                                    self.max_loop)
 
                 if self.lines: self.progress(maxLine / self.lines)
 
+            if self.lines: self.progress(maxLine / self.lines)
+
+        except PlanCancelled: raise
         except Exception as e:
             self.log_cb('error', str(e), os.path.basename(self.path), line, 0)
 
+        self._flush_block()
 
-    def run(self):
-        lastS = 0
-        speed = 0
-        first = True
-        x, y, z = 0, 0, 0
-
-        with gzip.open('positions.gz', 'wb') as f1:
-            with gzip.open('speeds.gz', 'wb') as f2:
-                for move in self._run():
-                    x = move.get('x', x)
-                    y = move.get('y', y)
-                    z = move.get('z', z)
-                    rapid = move.get('rapid', False)
-                    speed = move.get('s', speed)
-                    s = struct.pack('<f', math.nan if rapid else speed)
-
-                    if not first and s != lastS:
-                        f1.write(p)
-                        f2.write(s)
-
-                    lastS = s
-                    first = False
-                    p = struct.pack('<fff', x, y, z)
-
-                    f1.write(p)
-                    f2.write(s)
-
-        with open('meta.json', 'w') as f:
+
+    def close(self):
+        self.scanner.close()
+
+        # Release planner callbacks
+        self.planner.set_resolver(None)
+        self.planner.set_logger(None)
+
+
+    def run(self, dir = '.'):
+        rapid = array('I', array('f', [math.nan]).tobytes())[0]
+
+        # Uncompressed geometry is streamed for display while planning
+        positions = os.path.join(dir, 'positions')
+        speeds = os.path.join(dir, 'speeds')
+
+        self.encoder = PathFormat.Encoder()
+        self.lods = [Decimator(tolerance, rapid)
+                     for tolerance in LOD_TOLERANCES]
+
+        with open(positions, 'wb') as f1, open(speeds, 'wb') as f2:
+            self.streams = (f1, f2)
+            if self.base is not None: self._load_base()
+            self._run()
+            self.streams = None
+
+        # The parent may still be streaming the worker's copy
+        if not self.worker:
+            os.unlink(positions)
+            os.unlink(speeds)
+
+        PathFormat.save(os.path.join(dir, 'path.bin'), self.encoder.encode())
+        lods = [dict(tolerance = 0, vertices = self.encoder.vertices)]
+
+        for level, lod in enumerate(self.lods, 1):
+            lod.finish()
+            path = os.path.join(dir, 'path.%d.bin' % level)
+            PathFormat.save(path, lod.encoder.encode())
+            lods.append(dict(tolerance = lod.tolerance,
+                             vertices = lod.encoder.vertices))
+
+        # End of program
+        self.time_lines.append(max(self.time_lines[-1:] + [self.lines]) + 1)
+        self.line_times.append(self.time)
+        data = PathFormat.encode_times(self.time_lines, self.line_times)
+        PathFormat.save(os.path.join(dir, 'times.bin'), data)
+
+        # Positions are in machine coordinates under these work offsets
+        offsets = {axis: self.state.get('offset_' + axis, 0) for axis in 'xyz'}
+        data = dict(offsets = offsets, checkpoints = self.checkpoints)
+        data = json.dumps(data, separators = (',', ':')).encode('utf8')
+        PathFormat.save(os.path.join(dir, 'checkpoints.bin'), data)
+
+        with open(os.path.join(dir, 'meta.json'), 'w') as f:
             meta = dict(
                 time = self.time,
                 lines = self.lines,
                 maxSpeed = self.maxSpeed,
                 bounds = self.get_bounds(),
-                messages = self.messages)
+                messages = self.messages,
+                format = PathFormat.VERSION,
+                lods = lods,
+                offsets = offsets,
+                violations = self.violations)
 
             json.dump(meta, f)
 
 
+def write_msg(**msg):
+    sys.stdout.write(json.dumps(msg, separators = (',', ':')) + '\n')
+    sys.stdout.flush()
+
+
+# Plans jobs read from stdin, one JSON object per line, until EOF.  Progress
+# and results are written to stdout as JSON lines.  SIGUSR1 cancels the
+# current job without exiting the worker.
+class Worker(object):
+    def __init__(self):
+        self.plan = None
+        self.active = False
+        self.cancelled = False
+        signal.signal(signal.SIGUSR1, self._cancel)
+
+
+    def _cancel(self, signum, frame):
+        if not self.active: return
+        self.cancelled = True
+        if self.plan is not None: self.plan.cancelled = True
+
+
+    def _run_job(self, job):
+        self.cancelled = False
+        self.active = True
+
+        try:
+            self.plan = Plan(job['gcode'], job['state'], job['config'],
+                             job['max_time'], job['max_loop'], True,
+                             job.get('lines'), job.get('limits'),
+                             job.get('base'))
+            if self.cancelled: raise PlanCancelled() # Cancelled during load
+            self.plan.run(job['dir'])
+            return dict(done = True)
+
+        except PlanCancelled: return dict(cancelled = True)
+        except Exception as e: return dict(error = str(e))
+
+        finally:
+            self.active = False
+            if self.plan is not None: self.plan.close()
+            self.plan = None
+
+
+    def run(self):
+        write_msg(ready = True)
+
+        while True:
+            line = sys.stdin.readline()
+            if not line: break # Parent closed the pipe
+            if not line.strip(): continue
+
+            write_msg(**self._run_job(json.loads(line)))
+
+
 parser = argparse.ArgumentParser(description = 'Buildbotics GCode Planner')
-parser.add_argument('gcode', help = 'The GCode file to plan')
-parser.add_argument('state', help = 'GCode state variables')
-parser.add_argument('config', help = 'Planner config')
+parser.add_argument('gcode', nargs = '?', help = 'The GCode file to plan')
+parser.add_argument('state', nargs = '?', help = 'GCode state variables')
+parser.add_argument('config', nargs = '?', help = 'Planner config')
 
 parser.add_argument('--max-time', default = 600,
                     type = int, help = 'Maximum planning time in seconds')
@@ -313,12 +802,20 @@ parser.add_argument('--max-loop', default = 30,
                     type = int, help = 'Maximum time in loop in seconds')
 parser.add_argument('--nice', default = 10,
                     type = int, help = 'Set "nice" process priority')
+parser.add_argument('--worker', action = 'store_true',
+                    help = 'Plan jobs read from stdin until EOF')
 
 args = parser.parse_args()
 
-state = json.loads(args.state)
-config = json.loads(args.config)
-
 os.nice(args.nice)
-plan = Plan(args.gcode, state, config)
-plan.run()
+
+if args.worker: Worker().run()
+
+else:
+    if args.config is None: parser.error('gcode, state and config required')
+
+    state = json.loads(args.state)
+    config = json.loads(args.config)
+
+    plan = Plan(args.gcode, state, config, args.max_time, args.max_loop)
+    plan.run()